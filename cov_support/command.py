@@ -29,6 +29,7 @@ def main(sysargs = sys.argv[1:]):
     
     parser.add_argument('--pangolin-prep', action="store_true",help="Run legacy pangolin prep pipeline",dest="pangolin_prep")
     parser.add_argument('--num-taxa', action="store",type=int,default=5,help="Number of taxa in guide tree",dest="num_taxa")
+    parser.add_argument('--snp-cache', action="store",help="SNP cache file to reuse between pangolin prep runs, SNPs are only called for new or changed sequences",dest="snp_cache")
     
     parser.add_argument('--update-web', action="store_true",help="Run website update pipeline",dest="update_web")    
     parser.add_argument('--website-dir', action="store",help="Path to website repo",dest="website_dir")    
@@ -119,6 +120,8 @@ def main(sysargs = sys.argv[1:]):
         config["fasta"]=alignment
         config["global_tree"]=tree
         config["num_taxa"]=num_taxa
+        if args.snp_cache:
+            config["snp_cache"]=os.path.join(cwd, args.snp_cache)
     # find the data
     if args.update_web:
         country_coordinates = pkg_resources.resource_filename('cov_support', 'data/country_coordinates.csv')
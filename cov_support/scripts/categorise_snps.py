@@ -2,10 +2,17 @@
 
 import argparse
 import collections
-from Bio import AlignIO
+import contextlib
+import io
+import multiprocessing
 import os
 import dendropy
 import csv
+import sys
+import numpy as np
+from snp_store import SnpStore
+from snp_functions import read_fasta
+from packed_alignment import is_packed_alignment, PackedAlignment
 cwd = os.getcwd()
 
 """
@@ -27,10 +34,10 @@ B,WH0X/Taxon/Name
 def parse_args():
     parser = argparse.ArgumentParser(description='Find all snps.')
 
-    parser.add_argument("-a", action="store", type=str, dest="a")
+    parser.add_argument("-a", action="store", type=str, dest="a", help="Fasta alignment or packed alignment directory, only needed if the snp store has no sequence stats")
     parser.add_argument("--global-tree", action="store", type=str, dest="global_tree")
     parser.add_argument("-l", action="store", type=str, dest="l")
-    parser.add_argument("--snps",action="store", type=str, dest="snps")
+    parser.add_argument("--snps",action="store", type=str, dest="snps", help="Snp store directory or taxon,snps csv written by find_all_snps.py")
     parser.add_argument("--polytomy",action="store", type=str, dest="polytomy")
     parser.add_argument("--to-include",action="store", type=str, dest="include_file")
 
@@ -41,14 +48,17 @@ def parse_args():
     parser.add_argument("--defining-cut-off", action="store", type=float, default=90,dest="def_cutoff")
     parser.add_argument("--represent-cut-off", action="store", type=float,default=10,dest="rep_cutoff")
     parser.add_argument("--num-taxa", action="store", type=float,default=2,dest="num_taxa")
+    parser.add_argument("-t","--threads", action="store", type=int, default=1, dest="threads",
+                        help="Categorise the snps of this many lineages at once")
     return parser.parse_args()
 
-def get_lineage_dict(alignment, lineage_file):
-    """Takes in lineage annotations and an alignment file. 
-    Outputs structured dict of seq records per lineage."""
+def get_lineage_dict(taxa, pcent_N, lineage_file):
+    """Takes in lineage annotations and the taxa of the alignment with their
+    pcent_N. Outputs a dict of lineage to an array of the rows (indices into
+    taxa) of its taxa, sorted by pcent_N."""
     
     lineages_dict = {}
-    lineages_records = collections.defaultdict(list)
+    lineages_rows = collections.defaultdict(list)
     sorted_by_n_lineages = {}
     with open(lineage_file,newline="") as f:
         reader = csv.DictReader(f)
@@ -56,21 +66,21 @@ def get_lineage_dict(alignment, lineage_file):
             lineages_dict[row["taxon"]]=row["lineage"]
     not_in_csv = []
     c= 0
-    for record in alignment:
-        if record.id != "Wuhan/WH04/2020":
-            if record.id in lineages_dict:
-                lineage = lineages_dict[record.id]
-                lineages_records[lineage].append(record)
+    for i, taxon in enumerate(taxa):
+        if taxon != "Wuhan/WH04/2020":
+            if taxon in lineages_dict:
+                lineage = lineages_dict[taxon]
+                lineages_rows[lineage].append(i)
                 c+=1
             else:
-                not_in_csv.append(record.id)
+                not_in_csv.append(taxon)
     print(f"{c} sequences added to lineages_records")
     print(f"Note: The following {len(not_in_csv)} sequences were found in alignment but not lineages csv file")
     for seq in not_in_csv:
         print(seq)
-    for lineage in lineages_records:
-        sorted_records = sorted(lineages_records[lineage], key = lambda x : x.annotations["pcent_N"])
-        sorted_by_n_lineages[lineage] = sorted_records
+    for lineage in lineages_rows:
+        rows = np.array(lineages_rows[lineage], dtype=np.int64)
+        sorted_by_n_lineages[lineage] = rows[np.argsort(pcent_N[rows], kind="stable")]
 
     print("Lineage\t\tNum sequences")
     for lineage in sorted(sorted_by_n_lineages):
@@ -79,178 +89,287 @@ def get_lineage_dict(alignment, lineage_file):
     return sorted_by_n_lineages
 
 
-def add_snps_annotation(alignment, snps):
-    """add list of snps relative to ref as an annotation to the seq record"""
-    total = len(alignment)
+def snp_to_code(snp):
+    """return the int64 code of a snp string, (position << 16) | (ref << 8) | alt. 
+    the empty string (a taxon with no snps) is code 0"""
+    if snp == "":
+        return 0
+    return (int(snp[:-2]) << 16) | (ord(snp[-2]) << 8) | ord(snp[-1])
+
+def code_to_snp(code):
+    """return the snp string of an int64 snp code"""
+    if code == 0:
+        return ""
+    return f"{code >> 16}{chr((code >> 8) & 255)}{chr(code & 255)}"
+
+def read_snp_table(snps, store=None):
+    """read a snp store or taxon,snps csv into the list of its taxa, 
+    CSR offsets and an array of snp codes, so that the snps of taxon i
+    are codes[offsets[i]:offsets[i+1]]. 
+    taxa without snps get the empty snp (code 0), just as "".split(";") gives [""].
+    a store that is already open can be passed in as store"""
+    if os.path.isdir(snps):
+        if store is None:
+            store = SnpStore(snps)
+        codes = (store.position.astype(np.int64) << 16) | (store.ref.astype(np.int64) << 8) | store.alt.astype(np.int64)
+        counts = np.diff(store.offsets)
+        offsets = np.concatenate(([0], np.cumsum(np.maximum(counts, 1))))
+        all_codes = np.zeros(offsets[-1], dtype=np.int64)
+        taxon = np.asarray(store.taxon)
+        all_codes[offsets[taxon] + np.arange(len(codes)) - store.offsets[taxon]] = codes
+        return store.taxa, offsets, all_codes
 
-    snp_dict = {}
+    taxa = []
+    offsets = [0]
+    codes = []
     with open(snps,newline="") as f:
         reader = csv.DictReader(f)
         for row in reader:
-            snp_dict[row["taxon"]]=row["snps"]
-
-    for record in alignment:
-        
-        snp_string = snp_dict[record.id]
-        record.annotations["snp_string"] = snp_string
-        
-        record_snps =snp_string.split(";")
-        record.annotations["snps"] = record_snps
-
-
-    print(total, "records annotated")
-
-def add_N_annotation(alignment):
-    """add pcent_N as an annotation to the seq record"""
-    for record in alignment:
-        pcent_N = get_N_content(record.seq)
-        record.annotations["pcent_N"] = pcent_N
-    print(len(alignment), "records annotated")
-        
-def get_N_content(seq):
-    """return the percentage N content for a given seq"""
-    num_N = str(seq).upper().count("N")
-    pcent_N = (num_N*100)/len(seq)
-    return pcent_N
-
-def get_singleton_snps(lineage, snp_counter):
-    """Returns a list of snps that only appear 
-    once within a given lineage, will be masked"""
-    singletons = []
-    for snp in snp_counter:
-        if len(snp_counter[snp]) == 1:
-            singletons.append((lineage, snp, snp_counter[snp][0]))
-    return singletons
-
-def get_inclusion_pcent(snp,snp_counter,total_in_lineage):
-    """return the percentage of taxa within a lineage that 
-    have a given snp. E.g. if all taxa have that snp ==100, 
-    if 3 taxa out of 12 have that particular snp, will return 25 etc."""
-    num_taxa_with_snp = len(snp_counter[snp])
-    inclusion_pcent = (100*num_taxa_with_snp)/total_in_lineage
-    return inclusion_pcent
-
-def get_represented_and_defining_snps(singletons, snp_counter, lineages_dict, defining_cut_off, represent_cut_off,lineage):
-    """based on cut offs, will return a list containing snps that are present
-    at a lineage defining level and a list containing snps that are present at 
-    a should-be-represented-in-the-tree level"""
-    defining = []
-    flagged = []
-    total_in_lineage = len(lineages_dict[lineage])
-    for snp in snp_counter:
-        singleton = False
-        for s in singletons:
-            s_snp = s[1]
-            if snp == s_snp:
-                singleton = True
-
-        if not singleton:
-            inclusion_pcent = get_inclusion_pcent(snp,snp_counter,total_in_lineage)
-
-            if inclusion_pcent > defining_cut_off:
-                defining.append(snp)
-            if inclusion_pcent > represent_cut_off:
-                flagged.append(snp)
-
-    return defining, flagged
-
-def get_ids_in_list_of_records(records):
-    """return ids in a set of seq records"""
-    ids = []
-    for record in records:
-        ids.append(record.id)
-    return ids
-
-def get_representative_taxa(lineage,lineage_snps,basal_snps,lineages_dict, flagged):
-    """for each set of snps in the lineage snp dict, get the record 
+            taxa.append(row["taxon"])
+            codes.extend(snp_to_code(snp) for snp in row["snps"].split(";"))
+            offsets.append(len(codes))
+    return taxa, np.array(offsets, dtype=np.int64), np.array(codes, dtype=np.int64)
+
+def get_taxon_index(taxa, snp_table):
+    """return the row in the snp table of every taxon. if a taxon 
+    is in the snp table more than once, its last row is used"""
+    table_taxa = snp_table[0]
+    if taxa is table_taxa:
+        return np.arange(len(taxa), dtype=np.int64)
+    index = {taxon: i for i, taxon in enumerate(table_taxa)}
+    return np.array([index[taxon] for taxon in taxa], dtype=np.int64)
+
+def get_entries(offsets, taxon_index):
+    """return the number of snp table entries of each taxon in taxon_index 
+    and the positions of all of those entries in the codes array, 
+    taxon by taxon"""
+    starts = offsets[taxon_index]
+    lengths = offsets[taxon_index + 1] - starts
+    entries = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    return lengths, entries
+
+def get_snp_strings(offsets, codes):
+    """return the ;-separated snp string of each taxon in CSR offsets and snp codes"""
+    snp_codes, snp_ids = np.unique(codes, return_inverse=True)
+    snp_names = [code_to_snp(code) for code in snp_codes.tolist()]
+    entry_snps = [snp_names[i] for i in snp_ids.ravel().tolist()]
+    offsets = offsets.tolist()
+    return [";".join(entry_snps[offsets[i]:offsets[i + 1]]) for i in range(len(offsets) - 1)]
+
+def read_alignment_stats(alignment_file):
+    """return the ids and pcent_N of the records of a fasta alignment, 
+    reading one record at a time"""
+    taxa = []
+    pcent_N = []
+    with open(alignment_file, "rb") as f:
+        for record_id, seq in read_fasta(f):
+            taxa.append(record_id)
+            pcent_N.append(((seq.count(b"N") + seq.count(b"n"))*100)/len(seq))
+    print(len(taxa), "records annotated")
+    return taxa, np.array(pcent_N, dtype=np.float64)
+
+def read_packed_alignment(alignment_file):
+    """return the ids and pcent_N of the rows of a packed alignment, 
+    counted straight from the memory-mapped matrix"""
+    packed = PackedAlignment(alignment_file)
+    num_N = packed.count_chars(b"Nn").astype(np.int64)
+    print(len(packed.ids), "records annotated")
+    return packed.ids, (num_N*100)/packed.get_alignment_length()
+
+def read_store_stats(store):
+    """return the taxa and pcent_N of a snp store, from the sequence 
+    stats find_all_snps.py wrote to the store, so the alignment doesn't 
+    have to be read at all"""
+    pcent_N = (np.asarray(store.num_N, dtype=np.int64)*100)/np.asarray(store.length, dtype=np.int64)
+    print(len(store.taxa), "records annotated")
+    return store.taxa, pcent_N
+
+def get_lineage_snp_stats(lineages_dict, taxa, taxon_index, snp_table, defining_cut_off, represent_cut_off):
+    """count every snp in every lineage in one grouped computation and
+    return a dict of per lineage stats:
+        num_snps: number of different snps in the lineage
+        singletons: (lineage, snp, taxon) for snps that only appear once 
+            within the lineage, will be masked
+        defining: non-singleton snps in more than defining_cut_off % of 
+            the lineage's taxa
+        flagged: non-singleton snps in more than represent_cut_off % of 
+            the lineage's taxa, should be represented in the tree
+
+    The taxon x snp matrix is held as its nonzero entries (row, snp id), with
+    the rows in lineage order and then in the lineage's order of taxa.
+    Grouping the entries by (lineage label, snp id) gives every lineage's 
+    counts at once. The first entry of each group gives the order in which 
+    each lineage's snps are listed, the same order as counting the snps 
+    taxon by taxon"""
+    table_taxa, offsets, codes = snp_table
+    lineages = sorted(lineages_dict)
+
+    rows = np.concatenate([lineages_dict[lineage] for lineage in lineages] + [np.zeros(0, dtype=np.int64)])
+    lineage_sizes = np.array([len(lineages_dict[lineage]) for lineage in lineages], dtype=np.int64)
+    row_lineages = np.repeat(np.arange(len(lineages)), lineage_sizes)
+
+    lengths, entries = get_entries(offsets, taxon_index[rows])
+    entry_rows = np.repeat(np.arange(len(rows)), lengths)
+    snp_codes, entry_snp_ids = np.unique(codes[entries], return_inverse=True)
+    entry_snp_ids = entry_snp_ids.ravel()
+
+    num_snps = len(snp_codes)
+    groups, first_entry, counts = np.unique(row_lineages[entry_rows] * num_snps + entry_snp_ids, return_index=True, return_counts=True)
+    group_lineages = groups // num_snps
+    group_snps = [code_to_snp(code) for code in snp_codes[groups % num_snps].tolist()]
+
+    inclusion_pcent = (100*counts)/lineage_sizes[group_lineages]
+    singleton = counts == 1
+    defining = ~singleton & (inclusion_pcent > defining_cut_off)
+    flagged = ~singleton & (inclusion_pcent > represent_cut_off)
+    singleton_rows = rows[entry_rows[first_entry]]
+
+    stats = {}
+    for i, lineage in enumerate(lineages):
+        stats[lineage] = {"num_snps": 0, "singletons": [], "defining": [], "flagged": set()}
+    group_lineages = group_lineages.tolist()
+    singleton = singleton.tolist()
+    defining = defining.tolist()
+    flagged = flagged.tolist()
+    singleton_rows = singleton_rows.tolist()
+    for g in np.lexsort((first_entry, group_lineages)).tolist():
+        lineage_stats = stats[lineages[group_lineages[g]]]
+        lineage_stats["num_snps"] += 1
+        if singleton[g]:
+            lineage_stats["singletons"].append((lineages[group_lineages[g]], group_snps[g], taxa[singleton_rows[g]]))
+        if defining[g]:
+            lineage_stats["defining"].append(group_snps[g])
+        if flagged[g]:
+            lineage_stats["flagged"].add(group_snps[g])
+    return stats
+
+def get_representative_taxa(lineage_snps,basal_snps, flagged):
+    """for each set of snps in the lineage snp dict, get the taxon 
     with the lowest n content that has that snp pattern. 
     for each snp in that set of snps, if it was flagged that it should be 
-    represented in the guide tree, but hasn't been included yet, include that record
-    and note the snps the record has contributed to the tree. 
-    return the set of records that fulfill the representation needed."""
-    represented= []
+    represented in the guide tree, but hasn't been included yet, include that taxon
+    and note the snps the taxon has contributed to the tree. 
+    return the list of taxa that fulfill the representation needed."""
+    represented = set()
     taxa = []
+    taxa_ids = set()
     print("Representative seqs:")
     lowest_basal_Ns = []
     for snp_set in basal_snps:
-        records_sorted_by_N = sorted(basal_snps[snp_set], key = lambda x : int(x[1]))
-        lowest_N = records_sorted_by_N[0]
+        lowest_N = min(basal_snps[snp_set], key = lambda x : int(x[1]))
         lowest_basal_Ns.append(lowest_N)
-    lowest_basal = sorted(lowest_basal_Ns, key = lambda x : int(x[1]))[0][0]
+    lowest_basal = min(lowest_basal_Ns, key = lambda x : int(x[1]))[0]
     print(lowest_basal)
-    for record in lineages_dict[lineage]:
-        if record.id == lowest_N:
-            taxa.append(record)
 
     for snp_set in lineage_snps:
 
-        records_sorted_by_N = sorted(lineage_snps[snp_set], key = lambda x : int(x[1]))
-        lowest_N = records_sorted_by_N[0][0]
+        to_represent = [snp for snp in snp_set.split(";") if snp in flagged and snp not in represented]
+        if not to_represent:
+            continue
+        represented.update(to_represent)
 
-        snps = snp_set.split(";")
-        
-        for snp in snps:
-            if snp in flagged and not snp in represented:
-                
-                represented.append(snp)
-
-                for record in lineages_dict[lineage]:
-                    if record.id == lowest_N:
-                        snps_in_lowest_N = record.annotations["snps"]
-                        for lowest_N_snp in snps_in_lowest_N:
-                            represented.append(snp)
-                            taxa_ids = get_ids_in_list_of_records(taxa)
-                            if record.id not in taxa_ids:
-                                taxa.append(record)
+        lowest_N = min(lineage_snps[snp_set], key = lambda x : int(x[1]))[0]
+        if lowest_N not in taxa_ids:
+            taxa_ids.add(lowest_N)
+            taxa.append(lowest_N)
 
     return taxa
 
-def check_include_file(taxa, lineages_dict, lineage, include_file):
-    include = []
+def read_include_file(include_file):
+    """return a dict of lineage to the set of taxa that must be representatives"""
+    include = collections.defaultdict(set)
     with open(include_file,newline="") as f:
         reader = csv.DictReader(f)
         for row in reader:
-            if row["lineage"]==lineage:
-                include.append(row["taxon"])
-    for record in lineages_dict[lineage]:
-        if record.id in include:
-            taxa.append(record)
-            print(f"Adding {record.id} to representatives for {lineage}")
+            include[row["lineage"]].add(row["taxon"])
+    return include
+
+def check_include_file(taxa, lineage_taxa, lineage, include):
+    for taxon in lineage_taxa:
+        if taxon in include:
+            taxa.append(taxon)
+            print(f"Adding {taxon} to representatives for {lineage}")
     return taxa
     
 
-def pad_taxa(taxa, lineages_dict, lineage,num_taxa):
+def pad_taxa(taxa, lineage_taxa, lineage,num_taxa):
     """if you have filled the representatives needed but dont have 
     very many taxa, pad that list to five for the craic"""
     pre_len = len(taxa)
-    if pre_len < num_taxa:
-        for record in lineages_dict[lineage]:
-            if len(taxa)<num_taxa:
-                taxa_ids = get_ids_in_list_of_records(taxa)
-                if record.id not in taxa_ids:
-                    taxa.append(record)
-            else:
-                pass
-        else:
-            pass
+    taxa_ids = set(taxa)
+    for taxon in lineage_taxa:
+        if len(taxa) >= num_taxa:
+            break
+        if taxon not in taxa_ids:
+            taxa_ids.add(taxon)
+            taxa.append(taxon)
     print(f"\t5f. {lineage}: {pre_len} padded to {len(taxa)} representative seqs")   
     return taxa
 
+def get_lineage_data(lineage, rows, taxa, pcent_N, is_basal, taxon_index, snp_table, stats, include, num_taxa):
+    """return the compact data needed to categorise the snps of a lineage:
+    the taxon ids, pcent_N and basal flags of its rows (in the lineage's order),
+    their snps as CSR offsets and snp codes, its snp stats and its taxa to include"""
+    table_taxa, offsets, codes = snp_table
+    lengths, entries = get_entries(offsets, taxon_index[rows])
+    snp_offsets = np.concatenate(([0], np.cumsum(lengths)))
+    lineage_taxa = [taxa[i] for i in rows.tolist()]
+    return (lineage, lineage_taxa, pcent_N[rows].tolist(), snp_offsets, codes[entries], is_basal[rows].tolist(), stats, include[lineage], num_taxa)
+
+def categorise_lineage(lineage_data):
+    """find the representatives, singletons and defining snps of one lineage.
+    the log is captured and returned so the logs of lineages run in 
+    parallel don't interleave.
+    returns (lineage, representative taxa, singletons, defining snp string, log)"""
+    lineage, taxa, pcent_Ns, snp_offsets, snp_codes, is_basal, stats, include, num_taxa = lineage_data
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        print(lineage)
+        snp_strings = get_snp_strings(snp_offsets, snp_codes)
+        lineage_snps = collections.defaultdict(list)
+        basal_snps = collections.defaultdict(list)
+
+        for taxon, pcent_N, snp_string, basal in zip(taxa, pcent_Ns, snp_strings, is_basal):
+
+            if basal:
+                basal_snps[snp_string].append((taxon,pcent_N))                
 
-def add_basal_polytomy_annotation(polytomy_file, lineages_dict,alignment):
+            lineage_snps[snp_string].append((taxon,pcent_N))
+
+        print(f"Number of basal snp patterns identified: {len(basal_snps)}")
+        print("4. Lineage",lineage)
+        print(f"\t4a. Made lineage_snps")
+        print(f"\t4b. Counted up {stats['num_snps']} snps")
+        singletons = stats["singletons"]
+        print(f"\t4c. Identified {len(singletons)} singletons in {lineage}")
+
+        defining,flagged = stats["defining"],stats["flagged"]
+        print(f"\t4d. Identified {len(defining)} potential defining snps in {lineage}")
+        print(f"\t4e. Flagged {len(flagged)} snps to be represented in {lineage}")
+        representatives = get_representative_taxa(lineage_snps,basal_snps, flagged)
+        representatives = check_include_file(representatives, taxa, lineage, include)
+        representatives = pad_taxa(representatives, taxa, lineage,num_taxa)
+
+        defining_snps = list(set.intersection(*[set(x.split(";")) for x in basal_snps]))
+        print(lineage, defining_snps)
+        if defining_snps == []:
+            for snp in defining:
+                defining_snps.append(snp)
+
+        lineage_str = snp_list_to_snp_string(defining_snps)
+        print(f"{lineage} defining snps: {lineage_str}")   
+    return lineage, representatives, singletons, lineage_str, log.getvalue()
 
-    polytomies = []
+
+def get_basal_polytomy_flags(polytomy_file, taxa):
+    """return a bool array of whether each taxon is in a basal polytomy"""
+    polytomies = set()
     with open(polytomy_file,newline="") as f:
         reader = csv.DictReader(f)
         for row in reader:
-            polytomies.append(row["taxon"])
+            polytomies.add(row["taxon"])
 
-    for record in alignment:
-        
-        if record.id in polytomies:
-            record.annotations["is_basal"] = True
-        else:
-            record.annotations["is_basal"] = False
+    return np.array([taxon in polytomies for taxon in taxa], dtype=bool)
 
 def snp_list_to_snp_string(snp_list):
     """turn a snp list into a `;`-separated string of snps that are sorted by 
@@ -258,19 +377,21 @@ def snp_list_to_snp_string(snp_list):
     snp_string = ";".join(sorted(snp_list, key = lambda x : int(x[:-2])))
     return snp_string
 
-def get_all_snps(alignment_file,lineage_file,snp_file,polytomy_file,include_file,outfile,num_taxa,defining_cut_off,represent_cut_off):
+def get_all_snps(alignment_file,lineage_file,snp_file,polytomy_file,include_file,outfile,num_taxa,defining_cut_off,represent_cut_off,threads=1):
     """ this is the main worker function of this script. 
     ultimately it returns a list of singleton snps to_mask
     and a list of lineage_defining_snps per lineage to write to a file
 
-    1. reads in the alignment
+    1. reads in the taxa and their N content from the snp store (or the alignment)
 
-    3. adds in some useful things to the seq record (n, snps, snp_string)
+    2. reads the snp table and finds the row of every taxon in it
 
-    4. structures alignment records by lineage
-    5. for each lineage
+    3. groups the taxa by lineage as arrays of rows, and flags the basal ones
+
+    4. counts every snp in every lineage
+    5. for each lineage (with threads > 1, lineages are run in a process pool largest first)
         - count occurences of each snp and id singletons to mask
-        - make dict keyed by unique snp combinations with all the associated records as value list
+        - make dict keyed by unique snp combinations with all the associated taxa as value list
         - get snps to be represented in the tree and potential defining snps (by % cut off args)
         - get best taxa to represent the snps to be represented based on N content
         - if theres too few taxa for each lineage add some more (total of 5)
@@ -279,69 +400,55 @@ def get_all_snps(alignment_file,lineage_file,snp_file,polytomy_file,include_file
         - if snp set is empty, pad with snps flagged as potential defining snps by the less strict cut off
     6. return to_mask and lineage_defining_snps
     """
-    print("1. Reading in the alignment")
-    aln = AlignIO.read(alignment_file, "fasta")
-    print("2a. Annotating N content onto seq records")
-    add_N_annotation(aln)
-    print("2b. Annotating snps onto seq records")
-    add_snps_annotation(aln, snp_file)
+    store = SnpStore(snp_file) if os.path.isdir(snp_file) else None
+    if store is not None and store.has_stats:
+        print("1. Reading in the sequence stats from the snp store and counting N content")
+        taxa, pcent_N = read_store_stats(store)
+    elif alignment_file is None:
+        sys.stderr.write('Error: --snps is not a snp store with sequence stats, please give the alignment with -a\n')
+        sys.exit(-1)
+    elif is_packed_alignment(alignment_file):
+        print("1. Reading in the packed alignment and counting N content")
+        taxa, pcent_N = read_packed_alignment(alignment_file)
+    else:
+        print("1. Reading in the alignment and counting N content")
+        taxa, pcent_N = read_alignment_stats(alignment_file)
+    print("2. Reading in the snp table")
+    snp_table = read_snp_table(snp_file, store)
+    taxon_index = get_taxon_index(taxa, snp_table)
 
     print("3. Making lineages dict")
-    lineages_dict = get_lineage_dict(aln, lineage_file)
+    lineages_dict = get_lineage_dict(taxa, pcent_N, lineage_file)
     
-    print("3a. Adding basal polytomy annotations")
-    add_basal_polytomy_annotation(polytomy_file,lineages_dict,aln)
+    print("3a. Flagging basal polytomy taxa")
+    is_basal = get_basal_polytomy_flags(polytomy_file, taxa)
+
+    print("3b. Counting snps in all lineages")
+    lineage_snp_stats = get_lineage_snp_stats(lineages_dict, taxa, taxon_index, snp_table, defining_cut_off, represent_cut_off)
     to_mask = []
     lineage_defining_snps = []
-    print("3b. Adding basal annotations")
-    for lineage in sorted(lineages_dict):
-        print(lineage)
-        lineage_snps = collections.defaultdict(list)
-        snp_counter = collections.defaultdict(list)
-        basal_snps = collections.defaultdict(list)
-
-        for record in lineages_dict[lineage]:
-
-            snps = record.annotations["snps"]
-            snp_string = record.annotations["snp_string"]
-            pcent_N = record.annotations["pcent_N"]
-            
-            for i in snps:
-                snp_counter[i].append(record.id)
-
-            if record.annotations["is_basal"] == True:
-                basal_snps[snp_string].append((record.id,pcent_N))                
-
-            lineage_snps[snp_string].append((record.id,pcent_N))
+    include = read_include_file(include_file)
+    print("3c. Gathering the data of each lineage")
+    jobs = [get_lineage_data(lineage, lineages_dict[lineage], taxa, pcent_N, is_basal, taxon_index, snp_table, lineage_snp_stats[lineage], include, num_taxa) for lineage in sorted(lineages_dict)]
+    if threads > 1:
+        # largest lineages first, so a big lineage isn't left running on its own at the end
+        jobs.sort(key = lambda x : len(x[1]), reverse=True)
+        with multiprocessing.Pool(threads) as pool:
+            results = {}
+            for result in pool.imap_unordered(categorise_lineage, jobs):
+                results[result[0]] = result
+        results = [results[lineage] for lineage in sorted(results)]
+    else:
+        results = map(categorise_lineage, jobs)
 
-        print(f"Number of basal snp patterns identified: {len(basal_snps)}")
-        print("4. Lineage",lineage)
-        print(f"\t4a. Made lineage_snps")
-        print(f"\t4b. Counted up {len(snp_counter)} snps")
-        singletons = get_singleton_snps(lineage, snp_counter)
-        print(f"\t4c. Identified {len(singletons)} singletons in {lineage}")
+    for lineage, taxa, singletons, lineage_str, log in results:
+        print(log, end="")
         for singleton in singletons:
             to_mask.append(singleton)
 
-        defining,flagged = get_represented_and_defining_snps(singletons, snp_counter, lineages_dict, defining_cut_off,represent_cut_off,lineage)
-        print(f"\t4d. Identified {len(defining)} potential defining snps in {lineage}")
-        print(f"\t4e. Flagged {len(flagged)} snps to be represented in {lineage}")
-        taxa = get_representative_taxa(lineage,lineage_snps,basal_snps,lineages_dict, flagged)
-        taxa = check_include_file(taxa, lineages_dict, lineage, include_file)
-        taxa = pad_taxa(taxa, lineages_dict, lineage,num_taxa)
-
-        for record in taxa:
-            snp_string = record.annotations["snp_string"]
-            outfile.write(f"{lineage},{record.id}\n")
-        
-        defining_snps = list(set.intersection(*[set(x.split(";")) for x in basal_snps]))
-        print(lineage, defining_snps)
-        if defining_snps == []:
-            for snp in defining:
-                defining_snps.append(snp)
+        for taxon in taxa:
+            outfile.write(f"{lineage},{taxon}\n")
 
-        lineage_str = snp_list_to_snp_string(defining_snps)
-        print(f"{lineage} defining snps: {lineage_str}")   
         lineage_defining_snps.append((lineage, lineage_str))
         
     return to_mask, lineage_defining_snps
@@ -350,12 +457,14 @@ def read_alignment_and_write_files():
 
     args = parse_args()
 
-    alignment_file = os.path.join(cwd, args.a)
-    if not os.path.exists(alignment_file):
-        sys.stderr.write('Error: cannot find alignment file at {}\n'.format(alignment_file))
-        sys.exit(-1)
-    else:
-        print(f"Reading in alignment file {alignment_file}.")
+    alignment_file = None
+    if args.a:
+        alignment_file = os.path.join(cwd, args.a)
+        if not os.path.exists(alignment_file):
+            sys.stderr.write('Error: cannot find alignment file at {}\n'.format(alignment_file))
+            sys.exit(-1)
+        else:
+            print(f"Reading in alignment file {alignment_file}.")
 
     polytomy_file = os.path.join(cwd, args.polytomy)
     if not os.path.exists(polytomy_file):
@@ -392,7 +501,7 @@ def read_alignment_and_write_files():
 
     fw = open(args.representative_out, "w")
     fw.write("lineage,name\n")
-    to_mask,lineage_defining_snps = get_all_snps(alignment_file,lineage_file,snp_file,polytomy_file,include_file,fw,num_taxa,defining_cut_off,represent_cut_off)
+    to_mask,lineage_defining_snps = get_all_snps(alignment_file,lineage_file,snp_file,polytomy_file,include_file,fw,num_taxa,defining_cut_off,represent_cut_off,args.threads)
     fw.close()
     print("6. Writing mask, representatives and defining snps files.")
     with open(args.mask_out,"w") as fm:
@@ -4,11 +4,24 @@ import argparse
 import collections
 from Bio import AlignIO
 import os
+import sys
+import shutil
+import tempfile
+import sqlite3
+import multiprocessing
+import numpy as np
+from snp_functions import alignment_to_matrix, call_snps_in_matrix, format_snps, get_fasta_shards, get_reference_row, get_seq_stats, read_fasta, read_lines_in_range, seq_to_array, ReferenceMap
+from snp_store import SnpStore, SnpStoreWriter
+from snp_cache import SnpCache
+from packed_alignment import is_packed_alignment, PackedAlignment
 cwd = os.getcwd()
 
 """
 Current output:
---snps
+--snp-store
+binary columnar snp table with per sequence qc stats, see snp_store.py
+
+-o (optional csv export)
 taxon,snps
 taxon1,2897GT;30000TA
 
@@ -18,28 +31,21 @@ taxon1,2897GT;30000TA
 def parse_args():
     parser = argparse.ArgumentParser(description='Find all snps.')
 
-    parser.add_argument("-a", action="store", type=str, dest="a")
+    parser.add_argument("-a", action="store", type=str, dest="a", help="Fasta alignment or packed alignment directory")
 
-    parser.add_argument("-o", action="store", type=str, dest="snps")
-    return parser.parse_args()
+    parser.add_argument("-o", action="store", type=str, dest="snps", help="Optional taxon,snps csv export")
+    parser.add_argument("--snp-store", action="store", type=str, dest="snp_store", help="Directory to write the binary snp store to")
 
-def find_snps(ref,member):
-    """Identifies unambiguous snps between two sequences 
-    and returns them as a list, using position in the ref seq (i.e. no gaps in ref)"""
-    snps = []
-    index = 0 
-    for i in range(len(ref)):
-        if ref[i]!= '-':
-            index +=1
-            
-        col = [ref[i],member[i]]
-        if len(set(col))>1:
-            if not col[1].lower() in ["a","g","t","c","-"]:
-                pass
-            else:
-                snp = f"{index}{col[0].upper()}{col[1].upper()}"
-                snps.append(snp)
-    return snps
+    parser.add_argument("--stream", action="store_true", dest="stream",
+                        help="Read the alignment one record at a time and write snps as they are found, in constant memory")
+    parser.add_argument("--reference", action="store", type=str, dest="reference",
+                        help="Fasta file with the reference sequence (first record) for --stream, must be the same length as the alignment. Default: find the reference id in the alignment")
+    parser.add_argument("--reference-id", action="store", type=str, default="Wuhan/WH04/2020", dest="reference_id")
+    parser.add_argument("--snp-cache", action="store", type=str, dest="snp_cache",
+                        help="Cache file of snps keyed by sequence hash, snps are only called for new or changed sequences")
+    parser.add_argument("-t","--threads", action="store", type=int, default=1, dest="threads",
+                        help="Split the alignment into shards and find snps in this many processes, implies --stream")
+    return parser.parse_args()
 
 def get_reference(alignment,reference_id="Wuhan/WH04/2020"):
     """get reference seq record"""
@@ -50,21 +56,91 @@ def get_reference(alignment,reference_id="Wuhan/WH04/2020"):
 def pcent_done(c, total):
     return round((c*100)/total, 2)
 
-def write_snps(alignment, reference,outfile):
+def write_snp_block(ids, matrix, ref_map, outfile, store, cache):
+    """find the snps for a block of alignment rows, from the cache if there
+    is one, and write them to the csv and/or the snp store, whichever are given.
+    the store also gets the qc stats of each row"""
+    stats = get_seq_stats(matrix) if store is not None else None
+    if cache is not None:
+        hashes = [seq_hash.tobytes() for seq_hash in stats["seq_hash"]] if stats is not None else None
+        rows, positions, refs, alts = cache.call_snps(ids, matrix, ref_map, hashes)
+    else:
+        rows, positions, refs, alts = call_snps_in_matrix(ref_map, matrix)
+    if store is not None:
+        store.write_block(ids, rows, positions, refs, alts, stats)
+    if outfile is not None:
+        snps = format_snps(positions, refs, alts)
+        start = 0
+        for record_id, count in zip(ids, np.bincount(rows, minlength=len(ids)).tolist()):
+            snp_string = ";".join(snps[start:start + count])
+            outfile.write(f"{record_id},{snp_string}\n")
+            start += count
+
+def write_snps(alignment, reference,outfile,store,cache,block_size=1000):
     """add list of snps relative to ref as an annotation to the seq record"""
-    c = 0
-    total = len(alignment)
-    for record in alignment:
-        c +=1 
-        if c%500==0:
-            print(pcent_done(c, total), '%')
+    ids, matrix = alignment_to_matrix(alignment)
+    ref_map = ReferenceMap(seq_to_array(reference.seq))
 
-        snps = find_snps(reference.seq, record.seq)
-        snp_string =snp_list_to_snp_string(snps)
-        outfile.write(f"{record.id},{snp_string}\n")
+    total = len(ids)
+    for start in range(0, total, block_size):
+        write_snp_block(ids[start:start + block_size], matrix[start:start + block_size], ref_map, outfile, store, cache)
+        print(pcent_done(min(start + block_size, total), total), '%')
 
     print(total, "records annotated")
 
+def stream_snps(records, ref_map, outfile, store, cache, block_size=1000):
+    """read (id, seq) records one at a time into a reusable block 
+    and write the snps for each block as soon as it is full"""
+    matrix = np.empty((block_size, len(ref_map)), dtype=np.uint8)
+    ids = []
+    c = 0
+    for record_id, seq in records:
+        if len(seq) != len(ref_map):
+            raise ValueError(f"{record_id} has length {len(seq)} but the reference has length {len(ref_map)}, sequences must be aligned")
+        matrix[len(ids)] = np.frombuffer(seq, dtype=np.uint8)
+        ids.append(record_id)
+        if len(ids) == block_size:
+            write_snp_block(ids, matrix, ref_map, outfile, store, cache)
+            c += len(ids)
+            ids = []
+
+    write_snp_block(ids, matrix[:len(ids)], ref_map, outfile, store, cache)
+    c += len(ids)
+    return c
+
+def packed_snps(packed, start, end, ref_map, outfile, store, cache, block_size=1000):
+    """write the snps for rows start:end of a packed alignment, slicing
+    each block of rows straight from the memory-mapped matrix"""
+    if packed.get_alignment_length() != len(ref_map):
+        raise ValueError(f"the alignment has length {packed.get_alignment_length()} but the reference has length {len(ref_map)}, sequences must be aligned")
+    for block_start in range(start, end, block_size):
+        block_end = min(block_start + block_size, end)
+        write_snp_block(packed.ids[block_start:block_end], packed.matrix[block_start:block_end], ref_map, outfile, store, cache)
+    return end - start
+
+def write_shard_snps(shard):
+    """worker function: find the snps for the records in one byte range
+    of the fasta (or range of rows of a packed alignment) and write them to that shard's temporary csv and/or store.
+    new cache entries are passed back to be written by the main process"""
+    alignment_file, start, end, ref_map, shard_file, shard_store, cache_file = shard
+    fw = open(shard_file, "w") if shard_file else None
+    store = SnpStoreWriter(shard_store) if shard_store else None
+    cache = SnpCache(cache_file, ref_map, readonly=True) if cache_file else None
+    if is_packed_alignment(alignment_file):
+        c = packed_snps(PackedAlignment(alignment_file), start, end, ref_map, fw, store, cache)
+    else:
+        with open(alignment_file, "rb") as f:
+            c = stream_snps(read_fasta(read_lines_in_range(f, start, end)), ref_map, fw, store, cache)
+    if fw is not None:
+        fw.close()
+    if store is not None:
+        store.close()
+    cache_update = None
+    if cache is not None:
+        cache_update = (cache.take_pending(), cache.hits, cache.misses)
+        cache.close()
+    return shard_file, shard_store, cache_update, c
+
 def get_ids_in_list_of_records(records):
     """return ids in a set of seq records"""
     ids = []
@@ -72,13 +148,122 @@ def get_ids_in_list_of_records(records):
         ids.append(record.id)
     return ids
 
-def snp_list_to_snp_string(snp_list):
-    """turn a snp list into a `;`-separated string of snps that are sorted by 
-    position in the genome"""
-    snp_string = ";".join(sorted(snp_list, key = lambda x : int(x[:-2])))
-    return snp_string
+def get_stream_reference(alignment_file,reference_file=None,reference_id="Wuhan/WH04/2020"):
+    """return the reference map, with the reference row read either from a reference file or with 
+    a quick pass over the alignment that stops at the reference record"""
+    if reference_file:
+        ref_row = get_reference_row(reference_file)
+        print(f"First record in {reference_file}")
+    elif is_packed_alignment(alignment_file):
+        ref_row = PackedAlignment(alignment_file).get_row(reference_id)
+        if ref_row is not None:
+            ref_row = np.array(ref_row)
+        print(reference_id)
+    else:
+        ref_row = get_reference_row(alignment_file, reference_id)
+        print(reference_id)
+    if ref_row is None:
+        sys.stderr.write(f'Error: cannot find reference {reference_id} in the alignment\n')
+        sys.exit(-1)
+    return ReferenceMap(ref_row)
+
+def open_snp_cache(cache_file, ref_map):
+    """open the snp cache if one was given"""
+    if not cache_file:
+        return None
+    print(f"Using snp cache {cache_file}")
+    try:
+        return SnpCache(cache_file, ref_map)
+    except sqlite3.DatabaseError:
+        # a corrupt cache is just started again, all of its snps can be called again
+        print(f"Note: could not read the snp cache {cache_file}, starting a new one")
+        for filename in (cache_file, f"{cache_file}-wal", f"{cache_file}-shm"):
+            if os.path.exists(filename):
+                os.remove(filename)
+        return SnpCache(cache_file, ref_map)
+
+def close_snp_cache(cache):
+    """drop cache entries for taxa no longer in the alignment and print the cache stats"""
+    if cache is None:
+        return
+    evicted = cache.evict()
+    total = cache.hits + cache.misses
+    print(f"Snp cache: {cache.hits} hits, {cache.misses} misses ({pcent_done(cache.hits, max(total, 1))}% hit rate), {evicted} entries evicted")
+    cache.close()
 
-def get_all_snps(alignment_file,outfile):
+def get_all_snps_streaming(alignment_file,outfile,store,cache_file=None,reference_file=None,reference_id="Wuhan/WH04/2020"):
+    """ finds and writes all snps without holding the alignment in memory.
+
+    1. reads the reference row
+    2. makes one pass over the alignment, writing the snps for each record as it goes
+    """
+    print("1. Getting the reference:")
+    ref_map = get_stream_reference(alignment_file, reference_file, reference_id)
+    cache = open_snp_cache(cache_file, ref_map)
+
+    print("2. Streaming the alignment, finding and writing all snps")
+    if is_packed_alignment(alignment_file):
+        packed = PackedAlignment(alignment_file)
+        c = packed_snps(packed, 0, len(packed), ref_map, outfile, store, cache)
+    else:
+        with open(alignment_file, "rb") as f:
+            c = stream_snps(read_fasta(f), ref_map, outfile, store, cache)
+    print(c, "records annotated")
+    close_snp_cache(cache)
+
+def get_all_snps_threaded(alignment_file,outfile,store,threads,cache_file=None,reference_file=None,reference_id="Wuhan/WH04/2020"):
+    """ finds and writes all snps using a pool of processes.
+
+    1. reads the reference row
+    2. splits the alignment into byte ranges that start on a record 
+       (or ranges of rows for a packed alignment)
+    3. finds the snps for each shard in the pool, writing each to a temporary csv/store
+    4. appends the shards to the outputs in the order of the alignment, 
+       so the output is the same as a single process run
+    """
+    print("1. Getting the reference:")
+    ref_map = get_stream_reference(alignment_file, reference_file, reference_id)
+    cache = open_snp_cache(cache_file, ref_map)
+
+    print("2. Splitting the alignment into shards")
+    if is_packed_alignment(alignment_file):
+        shards = PackedAlignment(alignment_file).get_shards(threads * 4)
+    else:
+        shards = get_fasta_shards(alignment_file, threads * 4)
+    print(f"{len(shards)} shards")
+
+    print(f"3. Finding and writing all snps with {threads} threads")
+    c = 0
+    output_path = store.path if store is not None else outfile.name
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as tempdir:
+        jobs = []
+        for i, (start, end) in enumerate(shards):
+            shard_file = os.path.join(tempdir, f"shard_{i}.csv") if outfile is not None else None
+            shard_store = os.path.join(tempdir, f"shard_{i}") if store is not None else None
+            jobs.append((alignment_file, start, end, ref_map, shard_file, shard_store, cache_file))
+
+        if outfile is not None:
+            outfile.flush()
+        with multiprocessing.Pool(threads) as pool:
+            for shard_file, shard_store, cache_update, shard_count in pool.imap(write_shard_snps, jobs):
+                if shard_file:
+                    with open(shard_file) as f:
+                        shutil.copyfileobj(f, outfile)
+                    os.remove(shard_file)
+                if shard_store:
+                    store.append_store(SnpStore(shard_store))
+                    shutil.rmtree(shard_store)
+                if cache_update is not None:
+                    pending, hits, misses = cache_update
+                    cache.add_pending(*pending)
+                    cache.hits += hits
+                    cache.misses += misses
+                c += shard_count
+                print(c, "records annotated so far")
+    print(c, "records annotated")
+    close_snp_cache(cache)
+
+def get_all_snps(alignment_file,outfile,store,cache_file=None):
     """ this is the main worker function of this script. 
     ultimately it returns a list of singleton snps to_mask
     and a list of lineage_defining_snps per lineage to write to a file
@@ -104,9 +289,11 @@ def get_all_snps(alignment_file,outfile):
     print("2. Getting the reference:")
     reference = get_reference(aln)
     print(reference.id)
+    cache = open_snp_cache(cache_file, ReferenceMap(seq_to_array(reference.seq)))
 
     print("3. Find and write all snps")
-    write_snps(aln, reference,outfile)
+    write_snps(aln, reference,outfile,store,cache)
+    close_snp_cache(cache)
 
 
 def read_alignment_and_write_files():
@@ -120,9 +307,29 @@ def read_alignment_and_write_files():
     else:
         print(f"Reading in alignment file {alignment_file}.")
 
-    with open(args.snps,"w") as fw:
+    if not args.snps and not args.snp_store:
+        sys.stderr.write('Error: please specify a snp store (--snp-store) and/or csv (-o) to write\n')
+        sys.exit(-1)
+
+    fw = None
+    if args.snps:
+        fw = open(args.snps,"w")
         fw.write("taxon,snps\n")
-        get_all_snps(alignment_file,fw)
+    store = None
+    if args.snp_store:
+        store = SnpStoreWriter(args.snp_store)
+
+    if args.threads > 1:
+        get_all_snps_threaded(alignment_file,fw,store,args.threads,args.snp_cache,args.reference,args.reference_id)
+    elif args.stream or is_packed_alignment(alignment_file):
+        get_all_snps_streaming(alignment_file,fw,store,args.snp_cache,args.reference,args.reference_id)
+    else:
+        get_all_snps(alignment_file,fw,store,args.snp_cache)
+
+    if fw is not None:
+        fw.close()
+    if store is not None:
+        store.close()
 
 
 if __name__ == '__main__':
@@ -4,8 +4,10 @@ import argparse
 import collections
 from Bio import AlignIO
 import os
+import sys
 import csv
 import dendropy
+from polytomy_table import read_polytomies
 
 cwd = os.getcwd()
 
@@ -19,6 +21,7 @@ def parse_args():
 
 
     parser.add_argument("--outfile", action="store", type=str, dest="outfile")
+    parser.add_argument("--no-print-taxa", action="store_false", dest="print_taxa", help="Don't print each basal taxon")
 
     return parser.parse_args()
 
@@ -32,20 +35,6 @@ def add_phylotype_annotation(alignment,metadata):
     for record in alignment:
         record.annotations["phylotype"] = phylotype[record.id]
 
-def process_node(node, polytomies):
-    if len(node.child_nodes()) > 0:
-        zbl = []
-        for child in node.child_nodes():
-            length = int(child.edge.length * 29903)
-            if (length == 0 and len(child.child_nodes()) == 0):
-                zbl.append(child.taxon.label)
-        if (len(zbl) > 1):
-            for taxon in zbl:
-                polytomies[taxon] = zbl
-        for child in node.child_nodes():
-            process_node(child, polytomies)
-
-
 def get_phylotypes(metadata):
     phylotype = {}
     with open(metadata,newline="") as f:
@@ -55,71 +44,69 @@ def get_phylotypes(metadata):
 
     return phylotype
 
-def get_polytomy(polytomies):
-
-    polytomy = {}
-    with open(polytomies,newline="") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            polytomy[row["name"]]=row["polytomy"]
-    return polytomy
-
-
 def get_lineage_dict(lineage_file):
-
+    """return a dict of lineage to its taxa, in the order of the lineage file"""
     lineages = collections.defaultdict(list)
 
     with open(lineage_file,newline="") as f:
         reader = csv.DictReader(f)
         for row in reader:
-            tax_dict = {"name":row["taxon"]}
-            lineages[row["lineage"]].append(tax_dict)
+            lineages[row["lineage"]].append(row["taxon"])
 
     return lineages
 
-def find_basal_polytomy(polytomies, metadata, lineage_file, outfile):
+def get_phylotype_depth(phylotype):
+    """return the number of levels in a phylotype, e.g. 2 for UK1.2"""
+    if phylotype == "":
+        return 0
+    return phylotype.count(".") + 1
+
+def get_basal_phylotype_index(lineages, phylotypes):
+    """index the taxa of every lineage by phylotype depth in one pass.
+    returns a dict of lineage to (depth, phylotype, taxa) for the shallowest
+    phylotype in the lineage (the first one in the lineage file if 
+    there's a tie) and the lineage's taxa with that phylotype"""
+    basal_index = {}
+    for lineage in lineages:
+        basal = None
+        for taxon in lineages[lineage]:
+            if taxon not in phylotypes:
+                continue
+            phylotype = phylotypes[taxon]
+            depth = get_phylotype_depth(phylotype)
+            if basal is None or depth < basal[0]:
+                basal = (depth, phylotype, [taxon])
+            elif phylotype == basal[1]:
+                basal[2].append(taxon)
+        if basal is not None:
+            basal_index[lineage] = basal
+    return basal_index
+
+def find_basal_polytomy(polytomies, metadata, lineage_file, outfile, print_taxa=True):
     print("Getting phylotypes")
     phylotypes = get_phylotypes(metadata)
     print(f"{len(phylotypes)} read in")
     print("Getting polytomies")
-    polytomy_dict = get_polytomy(polytomies)
+    polytomy_dict, polytomy_members = read_polytomies(polytomies)
     print(f"{len(polytomy_dict)} members assigned")
     print("Getting lineage dict")
     lineages = get_lineage_dict(lineage_file)
     print(f"{len(lineages)} lineages loaded")
-
+    print("Indexing phylotypes")
+    basal_index = get_basal_phylotype_index(lineages, phylotypes)
 
     for lineage in lineages:
         print("\nLineage", lineage)
+        print(len(lineages[lineage]), "members")
 
-        lineage_taxa = lineages[lineage]
-        print(len(lineage_taxa), "members")
-
-        within_lineage_phylotypes = []
-        for record in lineage_taxa:
-
-            if record["name"] in phylotypes:
-                phylotype =phylotypes[record["name"]]
-                record["phylotype"] = phylotype
-                if phylotype == "":
-                    length = 0
-                else:
-                    length = len(phylotype.split("."))
-                within_lineage_phylotypes.append((phylotype, length))
+        if lineage not in basal_index:
+            sys.stderr.write(f'Error: no taxa in lineage {lineage} have a phylotype in the metadata\n')
+            sys.exit(-1)
+        depth, phylotype, basal_phylotype = basal_index[lineage]
         print("Within lineage phylotypes:")
-        shortest_phylotype= sorted(within_lineage_phylotypes, key = lambda x : x[1])[0]
-        print(shortest_phylotype)
-        basal_phylotype = []
-        for record in lineage_taxa:
-            if record["name"] in phylotypes:
-                if shortest_phylotype[0] == record["phylotype"]:
-                    
-                    basal_phylotype.append(record["name"])
-
-        basal_polytomy = []
-        for record in basal_phylotype:
-            if record in polytomy_dict:
-                basal_polytomy.append(record)
+        print((phylotype, depth))
+
+        basal_polytomy = [taxon for taxon in basal_phylotype if taxon in polytomy_dict]
         print("Basal polytomy", len(basal_polytomy))
 
         if basal_polytomy == []:
@@ -127,7 +114,8 @@ def find_basal_polytomy(polytomies, metadata, lineage_file, outfile):
             basal_polytomy = basal_phylotype
 
         for record in basal_polytomy:
-            print("Taxon", record)
+            if print_taxa:
+                print("Taxon", record)
             outfile.write(f"{lineage},{record}\n")
 
 def read_in_data_get_basal_polytomy():
@@ -158,7 +146,7 @@ def read_in_data_get_basal_polytomy():
     with open(args.outfile, "w") as fw:
         fw.write("lineage,taxon\n")
 
-        find_basal_polytomy(polytomies,metadata_file,lineage_file, fw)
+        find_basal_polytomy(polytomies,metadata_file,lineage_file, fw, args.print_taxa)
 
 
 if __name__ == '__main__':
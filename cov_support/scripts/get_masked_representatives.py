@@ -2,11 +2,14 @@
 
 import argparse
 import collections
-from Bio import AlignIO
-from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
 import os
 import sys 
 import csv
+from snp_functions import mask_snps, parse_snps, seq_to_array, ReferenceMap
+from packed_alignment import is_packed_alignment, PackedAlignment
+from fasta_index import FastaIndex
 
 cwd = os.getcwd()
 
@@ -16,53 +19,12 @@ def parse_args():
     parser.add_argument("--representatives", action="store", type=str, dest="representatives")
     parser.add_argument("--to-mask", action="store", type=str, dest="to_mask")
     parser.add_argument("-l", action="store", type=str, dest="l")
-    parser.add_argument("-a", action="store", type=str, dest="a")
+    parser.add_argument("-a", action="store", type=str, dest="a", help="Fasta alignment or packed alignment directory")
     parser.add_argument("--representative-seqs-out", action="store", type=str, dest="representatives_out")
     parser.add_argument("--metadata", action="store", type=str, dest="metadata_in")
     parser.add_argument("--metadata-out", action="store", type=str, dest="metadata_out")
     return parser.parse_args()
 
-def find_snps(ref,member):
-    """Identifies unambiguous snps between two sequences 
-    and returns them as a list"""
-    snps = []
-    index = 0 
-    for i in range(len(ref)):
-        if ref[i]!= '-':
-            index +=1
-            
-        col = [ref[i],member[i]]
-        if len(set(col))>1:
-            if not col[1].lower() in ["a","g","t","c","-"]:
-                pass
-            else:
-                snp = f"{index}{col[0].upper()}{col[1].upper()}"
-                snps.append(snp)
-    return snps
-
-def mask_snp(ref,member,to_mask_snp):
-    """Identifies unambiguous snps between two sequences 
-    and returns them as a list"""
-    new_str = ""
-    index = 0 
-    for i in range(len(ref)):
-        if ref[i]!= '-':
-            index +=1
-            
-        col = [ref[i],member[i]]
-        if len(set(col))>1:
-            if not col[1].lower() in ["a","g","t","c","-"]:
-                new_str +=col[1]
-            else:
-                snp = f"{index}{col[0].upper()}{col[1].upper()}"
-                if snp == to_mask_snp:
-                    new_str += "?"
-                else:
-                    new_str += col[1]
-        else:
-            new_str += col[1]
-    return new_str
-
 def make_lineage_dict(lineage):
     """return lineage dict lineage_dict[name]=lineage"""
     lineages = {}
@@ -87,63 +49,82 @@ def make_rep_dict(r):
         
 def make_mask_dict(m):
     """
-    return mask dict mask_dict[lineage]=snp
+    return mask dict mask_dict[lineage]=(positions, refs, alts) of the
+    lineage's snps, parsed once so they can be masked in one go
     input:
     --to_mask
     lineage,snp,taxon
     B,2897GT,WH0X/Taxon/Name
     """
-    to_mask = collections.defaultdict(list)
+    to_mask = collections.defaultdict(set)
     with open(m,"r") as f:
         for l in f:
             tokens = l.rstrip().split(",")
-            to_mask[tokens[0]].append(tokens[1])
-    return to_mask
+            to_mask[tokens[0]].add(tokens[1])
+    return {lineage: parse_snps(to_mask[lineage]) for lineage in to_mask}
+
+def open_alignment(alignment_file):
+    """return the packed alignment, or an index of the fasta alignment, 
+    to fetch records from by id"""
+    if is_packed_alignment(alignment_file):
+        return PackedAlignment(alignment_file)
+    return FastaIndex(alignment_file)
 
-def get_reference(fasta):
+def get_reference(alignment):
     """return reference seq record """
     reference = ""
-    for record in SeqIO.parse(fasta,"fasta"):
-        if "Wuhan/WH04/2020" == record.id:
-            reference = record
+    for record_id, seq in alignment.fetch(["Wuhan/WH04/2020"]):
+        reference = SeqRecord(Seq(seq.decode()), id=record_id)
     return reference
 
-def make_masked_representative_fasta(alignment_file, reps, reference, fw, to_mask):
-    aln = AlignIO.read(alignment_file,"fasta")
+def read_representatives(alignment, reps):
+    """return the seq records of the representatives, in alignment order,
+    reading only the representatives' records"""
+    return [SeqRecord(Seq(seq.decode()), id=record_id) for record_id, seq in alignment.fetch(reps)]
+
+def make_masked_representative_fasta(alignment, reps, reference, fw, to_mask):
+    aln = read_representatives(alignment, reps)
+    ref_map = ReferenceMap(seq_to_array(reference.seq))
     print("SNPs premask\t\tSNPs to mask\t\tSNPs postmask")
     for record in aln:
         if record.id != reference.id and record.id in reps:
-            snps = find_snps(reference.seq,record.seq)
             lineage = reps[record.id]
-            snp_mask_count = 0
             if lineage in to_mask:
-                
-                new_seq = record.seq
-                for snp in snps:
-                    if snp in to_mask[lineage]:
-                        snp_mask_count +=1
-                        new_seq = mask_snp(reference.seq, new_seq, snp)
-                    else:
-                        pass
-                
-                new_snps = find_snps(reference.seq,new_seq)
-                print(f"{len(snps)}\t\t{snp_mask_count}\t\t{len(new_snps)}")
+                masked_row, snp_count, snp_mask_count = mask_snps(ref_map, seq_to_array(record.seq), to_mask[lineage])
+                print(f"{snp_count}\t\t{snp_mask_count}\t\t{snp_count - snp_mask_count}")
 
+                new_seq = masked_row.tobytes().decode()
                 fw.write(f">{record.id}|{lineage}\n{new_seq}\n")
             else:
                 fw.write(f">{record.id}|{lineage}\n{record.seq}\n")
 
-def make_metadata_out(metadata,lineage_dict,reps,metadata_out_file):
+METADATA_COLUMNS = ["sequence_name","country","travel_history","sample_date","epi_week"]
+
+def get_metadata_columns(metadata):
+    """read only the header of the metadata and return the index of each
+    of the columns needed, or None if any of them are missing"""
+    with open(metadata,newline="") as f:
+        header = next(csv.reader(f), [])
+    header_index = {column: i for i, column in enumerate(header)}
+    if not all(column in header_index for column in METADATA_COLUMNS):
+        return None
+    return [header_index[column] for column in METADATA_COLUMNS]
+
+def make_metadata_out(metadata,metadata_columns,lineage_dict,reps,metadata_out_file):
+    """write the metadata of the taxa with lineages in one streaming pass, 
+    taking the fields from each row by column index"""
     c,cin,r = 0,0,0
+    num_columns = max(metadata_columns) + 1
     with open(metadata,newline="") as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        next(reader)
         for row in reader:
-            sequence_name = row["sequence_name"]
-            # gisaid_id = row["covv_accession_id"]
-            country = row["country"]
-            travel_history = row["travel_history"]
-            sample_date = row["sample_date"]
-            epi_week = row["epi_week"]
+            if not row:
+                continue
+            if len(row) < num_columns:
+                # short rows get None for the missing fields, as they did with csv.DictReader
+                row = row + [None] * (num_columns - len(row))
+            sequence_name,country,travel_history,sample_date,epi_week = [row[i] for i in metadata_columns]
 
             if sequence_name in lineage_dict:
                 rep = 0
@@ -209,16 +190,8 @@ def extract_representatives_and_do_the_masking_thing():
         sys.exit(-1)
     else:
         print(f"Reading in metadata file {metadata}.")
-        try:
-            with open(metadata,newline="") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    sequence_name = row["sequence_name"]
-                    edin_admin_0 = row["country"]
-                    travel_history = row["travel_history"]
-                    sample_date = row["sample_date"]
-                    epi_week = row["epi_week"]
-        except:
+        metadata_columns = get_metadata_columns(metadata)
+        if metadata_columns is None:
             sys.stderr.write("Error: unexpected headers in {}\n. \
                             Expected header names:\n\
                             sequence_name,\
@@ -234,17 +207,18 @@ def extract_representatives_and_do_the_masking_thing():
     else:
         print(f"Reading in alignment file {alignment_file}")
 
-    reference = get_reference(alignment_file)
+    alignment = open_alignment(alignment_file)
+    reference = get_reference(alignment)
     print(f"Using {reference.id} as reference")
 
     with open(args.representatives_out,"w") as fw:
         fw.write(f">{reference.id}|A\n{reference.seq}\n")
-        make_masked_representative_fasta(alignment_file, reps, reference, fw, to_mask)
+        make_masked_representative_fasta(alignment, reps, reference, fw, to_mask)
 
     with open(args.metadata_out, "w") as fm:
         header = f"name,country,travel history,sample date,epiweek,lineage,representative\n"
         fm.write(header)
-        make_metadata_out(metadata,lineage_dict,reps,fm)
+        make_metadata_out(metadata,metadata_columns,lineage_dict,reps,fm)
 
 if __name__ == '__main__':
 
@@ -4,8 +4,11 @@ import argparse
 import collections
 from Bio import AlignIO
 import os
+import sys
 import csv
-import dendropy
+import numpy as np
+from flat_tree import read_tree
+from polytomy_table import write_polytomies
 
 cwd = os.getcwd()
 
@@ -15,32 +18,43 @@ def parse_args():
 
     parser.add_argument('--global-tree',action="store", type=str, dest="global_tree")
 
-    parser.add_argument("--outfile", action="store", type=str, dest="outfile")
+    parser.add_argument("--outfile", action="store", type=str, dest="outfile", help="Polytomy id of each taxon in a polytomy")
+    parser.add_argument("--members-out", action="store", type=str, dest="members_out", help="Members of each polytomy. Default: <outfile>.members.csv")
 
     return parser.parse_args()
 
-def process_node(node, polytomies):
-    if len(node.child_nodes()) > 0:
-        zbl = []
-        for child in node.child_nodes():
-            length = int(child.edge.length * 29903)
-            if (length == 0 and len(child.child_nodes()) == 0):
-                zbl.append(child.taxon.label)
-        if (len(zbl) > 1):
-            for taxon in zbl:
-                polytomies[taxon] = zbl
-        for child in node.child_nodes():
-            process_node(child, polytomies)
-
+def find_polytomies(flat_tree, genome_length=29903):
+    """return the polytomies in a flat tree: the groups of more than one tip 
+    that hang off the same node by an edge of less than one snp over the genome.
+    the groups of tips are found by grouping the zero length tips by parent,
+    and are returned in preorder of their parent node with the tips in tree order"""
+    if np.isnan(flat_tree.edge_length[flat_tree.parent >= 0]).any():
+        raise ValueError("the tree has edges without a length, polytomies can't be found without branch lengths")
+    # less than one snp either way, the root has no edge and may be NaN
+    zero_length = np.abs(flat_tree.edge_length * genome_length) < 1
+    tips = np.flatnonzero(flat_tree.is_leaf & zero_length & (flat_tree.parent >= 0))
+    parents = flat_tree.parent[tips]
+    order = np.argsort(parents, kind="stable")
+    tips = tips[order]
+
+    group_parents, starts, counts = np.unique(parents[order], return_index=True, return_counts=True)
+    polytomies = []
+    for start, count in zip(starts[counts > 1].tolist(), counts[counts > 1].tolist()):
+        polytomies.append([flat_tree.labels[i] for i in tips[start:start + count].tolist()])
+    return polytomies
 
 def get_polytomy(global_tree):
-
-    tree = dendropy.Tree.get(file=open(global_tree, "r"), schema="nexus")
-
-    polytomies = {}
-    process_node(tree.seed_node, polytomies)
+    """return a dict of taxon to the id of its polytomy, 
+    and the list of polytomies indexed by id"""
+    flat_tree = read_tree(global_tree)
+
+    polytomies = find_polytomies(flat_tree)
+    polytomy_ids = {}
+    for polytomy_id, zbl in enumerate(polytomies):
+        for taxon in zbl:
+            polytomy_ids[taxon] = polytomy_id
     
-    return polytomies
+    return polytomy_ids, polytomies
 
 
 def read_in_data_get_polytomy():
@@ -53,17 +67,20 @@ def read_in_data_get_polytomy():
     else:
         print("Tree file found at", global_tree_file)
 
-    fb = open(args.outfile, "w")
-    fb.write("name,polytomy\n")
-
-    polytomies = get_polytomy(global_tree_file)
-    for tax in polytomies:
+    members_out = args.members_out
+    if not members_out:
+        members_out = "{}.members{}".format(*os.path.splitext(args.outfile))
 
-        polytomies_str = ";".join(polytomies[tax])
-        fb.write(f"{tax},{polytomies_str}\n")
-    fb.close()
+    try:
+        polytomy_ids, polytomies = get_polytomy(global_tree_file)
+    except ValueError as e:
+        sys.stderr.write('Error: {} in {}\n'.format(e, global_tree_file))
+        sys.exit(-1)
+    with open(args.outfile, "w") as fb, open(members_out, "w") as fm:
+        write_polytomies(polytomy_ids, polytomies, fb, fm)
+    print(f"{len(polytomy_ids)} taxa in {len(polytomies)} polytomies")
 
 
 if __name__ == '__main__':
 
-    read_in_data_get_polytomy()
\ No newline at end of file
+    read_in_data_get_polytomy()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import csv
+from packed_alignment import pack_alignment
+cwd = os.getcwd()
+
+"""
+Current output:
+-o
+packed alignment directory (ids.txt, seqs.bin, length.txt), see packed_alignment.py
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert a fasta alignment to a packed alignment.')
+
+    parser.add_argument("-a", action="store", type=str, dest="a")
+    parser.add_argument("-l", action="store", type=str, dest="l", help="Only pack the sequences in this lineages csv (and the reference)")
+    parser.add_argument("--reference-id", action="store", type=str, default="Wuhan/WH04/2020", dest="reference_id")
+
+    parser.add_argument("-o", action="store", type=str, dest="outdir")
+    return parser.parse_args()
+
+def get_taxa_with_lineage(lineage_file):
+    """return the set of taxa in the lineages csv"""
+    taxa = set()
+    with open(lineage_file,newline="") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            taxa.add(row["taxon"])
+    return taxa
+
+def read_alignment_and_pack():
+
+    args = parse_args()
+
+    alignment_file = os.path.join(cwd, args.a)
+    if not os.path.exists(alignment_file):
+        sys.stderr.write('Error: cannot find alignment file at {}\n'.format(alignment_file))
+        sys.exit(-1)
+    else:
+        print(f"Reading in alignment file {alignment_file}.")
+
+    keep = None
+    if args.l:
+        lineage_file = os.path.join(cwd, args.l)
+        if not os.path.exists(lineage_file):
+            sys.stderr.write('Error: cannot find lineage file at {}\n'.format(lineage_file))
+            sys.exit(-1)
+        else:
+            print(f"Reading in lineage file {lineage_file}.")
+        keep = get_taxa_with_lineage(lineage_file)
+        keep.add(args.reference_id)
+
+    c = pack_alignment(alignment_file, args.outdir, keep)
+    print(f"{c} sequences packed into {args.outdir}")
+
+
+if __name__ == '__main__':
+
+    read_alignment_and_pack()
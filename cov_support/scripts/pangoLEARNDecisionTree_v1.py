@@ -1,16 +1,20 @@
-import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn import metrics
 from sklearn.datasets import make_classification
 from sklearn.model_selection import StratifiedShuffleSplit
 from sklearn.tree import DecisionTreeClassifier
-from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score, classification_report, confusion_matrix, make_scorer
+from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score, classification_report, confusion_matrix
 from datetime import datetime
 import joblib
 import sys
 import os
-from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import StratifiedKFold
+from sklearn.metrics import precision_recall_fscore_support
+from sklearn.base import clone
+from joblib import Parallel, delayed
 from Bio import SeqIO
+import numpy as np
+from pangoLEARNEncoding import makeCodeLookup, oneHotEncode, oneHotHeaders, deduplicateRows, printDeduplicationReport, getCacheKey, saveTrainingData, loadTrainingData
 
 # file with lineage assignments
 lineage_file = sys.argv[1]
@@ -23,10 +27,8 @@ testing_percentage = 0.00000001
 # This reference sequence must be the same as is used in the pangolearn script!!
 referenceFile = sys.argv[3]
 
-# data storage
-dataList = []
-# dict for lookup efficiency
-indiciesToKeep = dict()
+# how many cross validation folds to run at once, all of the cores by default
+nJobs = int(sys.argv[4]) if len(sys.argv) > 4 else -1
 
 referenceId = "Wuhan/WH04/2020"
 referenceSeq = ""
@@ -38,18 +40,28 @@ mustKeepIds = ["Wuhan/WH04/2020", "Wuhan/WHU01/2020", "Italy/ABR-IZSGC-TE5166/20
 mustKeepLineages = ["A", "B", "B.1", "B.1.1", "B.1.177"]
 
 
-# function for handling weird sequence characters
-def clean(x, loc):
-	x = x.upper()
-	
-	if x == 'T' or x == 'A' or x == 'G' or x == 'C' or x == '-':
-		return x
+# lookup table for handling weird sequence characters. A, C, G, T and - are kept 
+# (in upper case), U becomes T, and anything else is 0 and is filled in from the reference
+cleanLookup = np.zeros(256, dtype=np.uint8)
+for base in "ACGT-":
+	cleanLookup[ord(base)] = ord(base)
+	cleanLookup[ord(base.lower())] = ord(base)
+cleanLookup[ord("U")] = ord("T")
+cleanLookup[ord("u")] = ord("T")
 
-	if x == 'U':
-		return 'T'
+# clean a whole sequence at once, returning it as a uint8 array
+def clean(seq):
+	seqRow = np.frombuffer(str(seq).encode(), dtype=np.uint8)
+	referenceRow = np.frombuffer(referenceSeq.encode(), dtype=np.uint8)
 
-	# otherwise return value from reference
-	return referenceSeq[loc]
+	if len(seqRow) != len(referenceRow):
+		sys.stderr.write("Error: sequence length " + str(len(seqRow)) + " does not match the reference length " + str(len(referenceRow)) + ", sequences must be aligned\n")
+		sys.exit(-1)
+
+	cleanRow = cleanLookup[seqRow]
+	unknown = cleanRow == 0
+	cleanRow[unknown] = referenceRow[unknown]
+	return cleanRow
 
 def findReferenceSeq():
 	with open(referenceFile) as f:
@@ -63,26 +75,13 @@ def findReferenceSeq():
 	return currentSeq
 
 
-def getDataLine(seqId, seq):
-	dataLine = []
-	dataLine.append(seqId)
-
-	newSeq = ""
-
-	# for each character in the sequence
-	for index in range(len(seq)):
-		newSeq = newSeq + clean(seq[index], index)
-
-	dataLine.append(newSeq)
-	
-	return dataLine
-
-
+# read in the sequences with a lineage assignment, returning their ids and
+# a uint8 matrix of the cleaned sequences with the reference as the first row
 def readInAndFormatData():
 
-	# add the data line for the reference seq
+	# add the reference seq
 	idToLineage[referenceId] = "A"
-	dataList.append(getDataLine(referenceId, referenceSeq))
+	ids = [referenceId]
 
 	# create a dictionary of sequence ids to their assigned lineages
 	with open(lineage_file, 'r') as f:
@@ -102,66 +101,38 @@ def readInAndFormatData():
 
 	for key in seq_dict.keys():
 		if key in idToLineage:
-			dataList.append(getDataLine(key, seq_dict[key]))
+			ids.append(key)
 		else:
 			print("unable to find the lineage classification for: " + key)
 
+	seqMatrix = np.empty((len(ids), len(referenceSeq)), dtype=np.uint8)
+	seqMatrix[0] = clean(referenceSeq)
+	for i in range(1, len(ids)):
+		seqMatrix[i] = clean(seq_dict[ids[i]])
 
-# find columns in the data list which always have the same value
-def findColumnsWithoutSNPs():
+	return ids, seqMatrix
 
-	# for each index in the length of each sequence
-	for index in range(len(dataList[0][1])):
-		keep = False
 
-		# loop through all lines
-		for line in dataList:
+# find the columns of the matrix in which any sequence differs from the reference,
+# a block of rows at a time. The first column is always kept, it is where the 
+# lineage assignment goes
+def findColumnsWithoutSNPs(seqMatrix, blockSize=1000):
+	keep = np.zeros(seqMatrix.shape[1], dtype=bool)
+	keep[0] = True
 
-			# if there is a difference somewhere, then we want to keep it
-			if dataList[0][1][index] != line[1][index] or index == 0:
-				keep = True
-				break
+	for start in range(0, len(seqMatrix), blockSize):
+		keep |= (seqMatrix[start:start + blockSize] != seqMatrix[0]).any(axis=0)
 
-		# otherwise, save it
-		if keep:
-			indiciesToKeep[index] = True
+	return np.flatnonzero(keep)
 
 
-# remove columns from the data list which don't have any SNPs. We do this because
+# remove columns from the data which don't have any SNPs. We do this because
 # these columns won't be relevant for a logistic regression which is trying to use
 # differences between sequences to assign lineages
-def removeOtherIndices(indiciesToKeep):
-
-	# instantiate the final list
-	finalList = []
-
-	indicies = list(indiciesToKeep.keys())
-	indicies.sort()
-
-	# while the dataList isn't empty
-	while len(dataList) > 0:
+def removeOtherIndices(ids, seqMatrix, indicies):
 
-		# pop the first line
-		line = dataList.pop(0)
-		seqId = line.pop(0)
-
-		line = line[0]
-		# initialize the finalLine
-		finalLine = []
-
-		for index in indicies:
-			if index == 0:
-				# if its the first index, then that's the lineage assignment, so keep it
-				finalLine.append(seqId)
-			else:
-				# otherwise keep everything at the indices in indiciesToKeep
-				finalLine.append(line[index])
-
-		# save the finalLine to the finalList
-		finalList.append(finalLine)
-
-	# return
-	return finalList
+	# the first index is replaced by the lineage assignment, so it isn't a feature
+	return seqMatrix[:, indicies[1:]]
 
 def allEqual(list):
 		entries = dict()
@@ -172,20 +143,28 @@ def allEqual(list):
 
 		return len(entries) == 1
 
-def removeAmbiguous():
+# remove sequences whose features are identical to sequences from other lineages, 
+# returning the rows that are kept and their lineages
+def removeAmbiguous(ids, featureMatrix):
 	idsToRemove = set()
 	lineMap = dict()
 	idMap = dict()
 
-	for line in dataList:
-		keyString = ",".join(line[1:])
+	# view each row of the feature matrix as a single value, so that rows with
+	# identical features can be grouped without making a string copy of each one
+	rowView = np.ascontiguousarray(featureMatrix).view(np.dtype((np.void, featureMatrix.shape[1])))[:, 0]
+	_, rowGroups, groupSizes = np.unique(rowView, return_inverse=True, return_counts=True)
 
-		if keyString not in lineMap:
-			lineMap[keyString] = []
-			idMap[keyString] = []
+	# only rows which share their features with another row can be ambiguous
+	for rowIndex in np.flatnonzero(groupSizes[rowGroups] > 1):
+		key = rowGroups[rowIndex]
 
-		lineMap[keyString].append(idToLineage[line[0]])
-		idMap[keyString].append(line[0])
+		if key not in lineMap:
+			lineMap[key] = []
+			idMap[key] = []
+
+		lineMap[key].append(idToLineage[ids[rowIndex]])
+		idMap[key].append(ids[rowIndex])
 
 	for key in lineMap:
 		if not allEqual(lineMap[key]):
@@ -225,75 +204,93 @@ def removeAmbiguous():
 					if m != idToLineage[i]:
 						idsToRemove.add(i)
 
-	newList = []
+	keptRows = []
+	lineages = []
 
 	print("keeping indicies:")
 
-	for line in dataList:
-		if line[0] not in idsToRemove:
-			print(line[0])
-			line[0] = idToLineage[line[0]]
-			newList.append(line);
+	for rowIndex, seqId in enumerate(ids):
+		if seqId not in idsToRemove:
+			print(seqId)
+			keptRows.append(rowIndex)
+			lineages.append(idToLineage[seqId])
 
-	return newList;
+	return keptRows, lineages;
 
 
-print("reading in data " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"), flush=True);
+# nucleotide symbols which can appear, in the column order get_dummies used to give them
+categories = ['-', 'A', 'C', 'G', 'T']
 
-referenceSeq = findReferenceSeq()
+# read in and prepare the training data, returning the one-hot encoded features,
+# lineages, sample weights and the genome indices the features come from
+def prepareTrainingData():
+	global referenceSeq
 
-readInAndFormatData()
+	print("reading in data " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"), flush=True);
 
-print("processing snps, formatting data " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"), flush=True);
+	referenceSeq = findReferenceSeq()
 
-findColumnsWithoutSNPs()
+	ids, seqMatrix = readInAndFormatData()
 
-dataList = removeOtherIndices(indiciesToKeep)
+	print("processing snps, formatting data " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"), flush=True);
 
-print("# sequences before blacklisting")
-print(len(dataList))
+	indiciesToKeep = findColumnsWithoutSNPs(seqMatrix)
 
-dataList = removeAmbiguous()
+	featureMatrix = removeOtherIndices(ids, seqMatrix, indiciesToKeep)
 
-print("# sequences after blacklisting")
-print(len(dataList))
+	print("# sequences before blacklisting")
+	print(len(ids))
 
-# headers are the original genome locations
-headers = list(indiciesToKeep.keys())
-headers[0] = "lineage"
+	keptRows, lineages = removeAmbiguous(ids, featureMatrix)
 
-print("setting up training " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"), flush=True);
+	print("# sequences after blacklisting")
+	print(len(keptRows))
 
-pima = pd.DataFrame(dataList, columns=headers)
+	# collapse identical sequences from the same lineage into one row, weighted by how many there were
+	uniqueRows, sampleWeights = deduplicateRows(featureMatrix[keptRows], lineages)
+	keptRows = np.asarray(keptRows)[uniqueRows]
+	lineages = np.asarray(lineages)[uniqueRows]
 
-# nucleotide symbols which can appear
-categories = ['A', 'C', 'G', 'T', '-']
+	printDeduplicationReport(sampleWeights)
 
-# one hot encoding of all headers other than the first which is the lineage
-dummyHeaders = headers[1:]
+	# one hot encoding of all headers other than the first which is the lineage,
+	# straight from the feature matrix into a sparse matrix
+	codeMatrix = makeCodeLookup(categories)[featureMatrix[keptRows]]
+	X = oneHotEncode(codeMatrix, len(categories))
+	y = np.array(lineages)
 
-# add extra rows to ensure all of the categories are represented, as otherwise 
-# not enough columns will be created when we call get_dummies
-for i in categories:
-	line = [i] * len(dataList[0])
-	pima.loc[len(pima)] = line
+	return X, y, sampleWeights, indiciesToKeep
 
-# get one-hot encoding
-pima = pd.get_dummies(pima, columns=dummyHeaders)
 
-# get rid of the fake data we just added
-pima.drop(pima.tail(len(categories)).index, inplace=True)
+# the prepared training data is cached next to the sequence file, and used again 
+# as long as the lineage, sequence and reference files haven't changed
+cacheFile = sequence_file + ".decisionTree.npz"
+cacheKey = getCacheKey("decisionTree", [lineage_file, sequence_file, referenceFile])
 
-feature_cols = list(pima)
+trainingData = loadTrainingData(cacheFile, cacheKey)
+
+if trainingData is None:
+	trainingData = prepareTrainingData()
+	saveTrainingData(cacheFile, cacheKey, *trainingData)
+else:
+	print("read training data from " + cacheFile, flush=True)
+
+X, y, sampleWeights, indiciesToKeep = trainingData
+
+# headers are the original genome locations
+headers = indiciesToKeep.tolist()
+headers[0] = "lineage"
+
+print("setting up training " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"), flush=True);
+
+feature_cols = ["lineage"] + oneHotHeaders(headers[1:], categories, "_")
 print(feature_cols)
 
-# remove the last column from the data frame. This is because we are trying to predict these values.
+# remove the first column name, it is the lineage we are trying to predict
 h = feature_cols.pop(0)
-X = pima[feature_cols]
-y = pima[h]
 
 # separate the data frame into testing/training data sets. 25% of the data will be used for training, 75% for test.
-X_train,X_test,y_train,y_test=train_test_split(X,y,test_size=testing_percentage,random_state=0)
+X_train,X_test,y_train,y_test,weights_train,weights_test=train_test_split(X,y,sampleWeights,test_size=testing_percentage,random_state=0)
 
 print("training " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"), flush=True);
 
@@ -303,7 +300,7 @@ joblib.dump(headers,  "decisionTreeHeaders_v1.joblib", compress=9)
 dt = DecisionTreeClassifier()
 
 # fit the model
-dt.fit(X,y)
+dt.fit(X,y,sample_weight=sampleWeights)
 
 print("testing " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"), flush=True);
 
@@ -320,12 +317,12 @@ print("generating statistics " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"),
 #print the confusion matrix
 print("--------------------------------------------")
 print("Confusion Matrix")
-cnf_matrix = metrics.confusion_matrix(y_test, y_pred)
+cnf_matrix = metrics.confusion_matrix(y_test, y_pred, sample_weight=weights_test)
 print(cnf_matrix)
 
 print("--------------------------------------------")
 print("Classification report")
-print(metrics.classification_report(y_test, y_pred, digits=3))
+print(metrics.classification_report(y_test, y_pred, digits=3, sample_weight=weights_test))
 
 # save the model files to compressed joblib files
 # using joblib instead of pickle because these large files need to be compressed
@@ -333,13 +330,43 @@ joblib.dump(dt,  "decisionTree_v1.joblib", compress=9)
 
 print("model files created", flush=True)
 
-# this method is used below when running 10-fold cross validation. It ensures
-# that the per-lineage statistics are generated for each cross-fold
-def classification_report_with_accuracy_score(y_true, y_pred):
+# fit a fresh model on the training rows of one cross validation fold and return
+# the predictions for its test rows
+def runCrossValidationFold(model, X, y, sampleWeights, trainRows, testRows):
+	model.fit(X[trainRows], y[trainRows], sample_weight=sampleWeights[trainRows])
+	return testRows, model.predict(X[testRows])
+
+# write the precision, recall, f1 score and support (number of sequences) of each lineage
+# over the predictions from all of the cross validation folds
+def writeRecallReport(y, crossValidationPred, sampleWeights, outfile):
+	lineages = sorted(set(y))
+	precision, recall, f1, support = precision_recall_fscore_support(y, crossValidationPred, labels=lineages, sample_weight=sampleWeights, zero_division=0)
+
+	with open(outfile, "w") as f:
+		f.write("lineage,precision,recall,f1,support\n")
+
+		for i in range(len(lineages)):
+			f.write(lineages[i] + "," + "{:.3f}".format(precision[i]) + "," + "{:.3f}".format(recall[i]) + "," + "{:.3f}".format(f1[i]) + "," + str(int(support[i])) + "\n")
+
+print("running cross validation " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"), flush=True);
+
+# run 10-fold cross validation, with the folds in parallel. joblib memory maps the
+# feature matrix so the workers share it instead of each getting a copy
+folds = StratifiedKFold(n_splits=10).split(X, y)
+foldResults = Parallel(n_jobs=nJobs)(delayed(runCrossValidationFold)(clone(dt), X, y, sampleWeights, trainRows, testRows) for trainRows, testRows in folds)
+
+# the per-lineage statistics for each cross-fold
+crossValidationPred = np.empty(len(y), dtype=y.dtype)
+cross_validation_scores = []
+
+for testRows, foldPred in foldResults:
+	crossValidationPred[testRows] = foldPred
+	cross_validation_scores.append(accuracy_score(y[testRows], foldPred, sample_weight=sampleWeights[testRows]))
+
 	print("--------------------------------------------")
 	print("Crossfold Classification Report")
-	print(metrics.classification_report(y_true, y_pred, digits=3))
-	return accuracy_score(y_true, y_pred)
+	print(metrics.classification_report(y[testRows], foldPred, digits=3, sample_weight=sampleWeights[testRows]))
+
+writeRecallReport(y, crossValidationPred, sampleWeights, "lineage_recall_report.csv")
 
-# optionally, run 10-fold cross validation (comment this out if not needed as it takes a while to run)
-cross_validation_scores = cross_val_score(dt, X=X, y=y, cv=10, scoring=make_scorer(classification_report_with_accuracy_score))
\ No newline at end of file
+print("lineage recall report written to lineage_recall_report.csv", flush=True)
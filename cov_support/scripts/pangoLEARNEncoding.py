@@ -0,0 +1,139 @@
+import os
+import hashlib
+import zipfile
+import numpy as np
+import scipy.sparse
+
+# shared feature encoding for the pangoLEARN training scripts. Sequences are held
+# as a uint8 matrix of their characters, one row per sequence, and are turned into
+# a sparse one-hot matrix with one column per (site, category) instead of building
+# a dense data frame and calling get_dummies on it
+
+
+# make a lookup table from the byte value of a character to the index of its category.
+# characters not in any category get the default, -1 means no category at all
+def makeCodeLookup(categories, default=-1):
+	codeLookup = np.full(256, default, dtype=np.int8)
+
+	for code, category in enumerate(categories):
+		for char in category:
+			codeLookup[ord(char)] = code
+
+	return codeLookup
+
+
+# one-hot encode a matrix of category codes as a CSR matrix. Site j with code k
+# goes in column j * numCategories + k, negative codes have no column set
+def oneHotEncode(codeMatrix, numCategories):
+	numRows, numSites = codeMatrix.shape
+
+	hasCode = codeMatrix >= 0
+	rows, sites = np.nonzero(hasCode)
+
+	# np.nonzero goes through the matrix row by row, so the columns are already
+	# in CSR order and sorted within each row
+	indices = sites.astype(np.int64) * numCategories + codeMatrix[rows, sites]
+	indptr = np.zeros(numRows + 1, dtype=np.int64)
+	np.cumsum(hasCode.sum(axis=1), out=indptr[1:])
+
+	data = np.ones(len(indices), dtype=np.uint8)
+
+	return scipy.sparse.csr_matrix((data, indices, indptr), shape=(numRows, numSites * numCategories))
+
+
+# column names for a one-hot matrix, in the same order as oneHotEncode, e.g.
+# 241_A or 241-A depending on the separator
+def oneHotHeaders(positions, names, separator):
+	headers = []
+
+	for position in positions:
+		for name in names:
+			headers.append(str(position) + separator + name)
+
+	return headers
+
+
+# find the distinct (row, lineage) pairs of a matrix. Returns the index of the first row
+# with each pair, in the order they appear, and the number of rows with that pair, which 
+# can be given to fit as a sample_weight in place of the duplicate rows
+def deduplicateRows(matrix, lineages):
+	matrix = np.ascontiguousarray(matrix)
+
+	# view each row as a single value so identical rows can be grouped without copying them
+	rowView = matrix.view(np.dtype((np.void, matrix.shape[1] * matrix.itemsize)))[:, 0]
+	_, rowGroups = np.unique(rowView, return_inverse=True)
+	lineageNames, lineageGroups = np.unique(np.asarray(lineages), return_inverse=True)
+
+	pairs = rowGroups.ravel().astype(np.int64) * len(lineageNames) + lineageGroups.ravel()
+	_, firstRows, pairCounts = np.unique(pairs, return_index=True, return_counts=True)
+
+	order = np.argsort(firstRows)
+	return firstRows[order], pairCounts[order]
+
+
+def printDeduplicationReport(sampleWeights):
+	print("# sequences before deduplication")
+	print(int(sampleWeights.sum()))
+	print("# distinct sequence and lineage pairs")
+	print(len(sampleWeights))
+	print("reduction factor: " + str(round(sampleWeights.sum() / len(sampleWeights), 2)))
+
+
+# change this whenever the way the training data is prepared changes, so that
+# training data cached by an older version isn't used
+ENCODING_VERSION = 1
+
+
+# make the key the training data cache is checked against, from the contents of
+# the input files, the trainer and the encoding version
+def getCacheKey(trainer, inputFiles):
+	cacheKey = hashlib.blake2b()
+	cacheKey.update((trainer + "\t" + str(ENCODING_VERSION)).encode())
+
+	for inputFile in inputFiles:
+		with open(inputFile, "rb") as f:
+			for chunk in iter(lambda: f.read(1 << 20), b""):
+				cacheKey.update(chunk)
+		# keep the boundary between files in the key
+		cacheKey.update(b"\0")
+
+	return cacheKey.hexdigest()
+
+
+# save prepared training data to an npz file: the sparse one-hot matrix, the lineages,
+# the sample weights and the kept genome indices that the headers are made from
+def saveTrainingData(cacheFile, cacheKey, X, y, sampleWeights, indicies):
+	tmpFile = cacheFile + "." + str(os.getpid()) + ".tmp.npz"
+
+	try:
+		np.savez(tmpFile,
+			cacheKey=np.array(cacheKey),
+			data=X.data,
+			indices=X.indices,
+			indptr=X.indptr,
+			shape=np.array(X.shape),
+			y=np.asarray(y, dtype=str),
+			sampleWeights=sampleWeights,
+			indicies=indicies)
+		os.replace(tmpFile, cacheFile)
+	except OSError:
+		print("could not save the training data cache to " + cacheFile)
+
+
+# return the training data saved by saveTrainingData as (X, y, sampleWeights, indicies),
+# or None if there's no cache, it was made from different inputs or it can't be read
+def loadTrainingData(cacheFile, cacheKey):
+	if not os.path.exists(cacheFile):
+		return None
+
+	try:
+		with np.load(cacheFile) as cache:
+			if str(cache["cacheKey"]) != cacheKey:
+				return None
+
+			X = scipy.sparse.csr_matrix((cache["data"], cache["indices"], cache["indptr"]), shape=tuple(cache["shape"]))
+
+			return X, cache["y"], cache["sampleWeights"], cache["indicies"]
+	except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+		print("could not read the training data cache " + cacheFile + ", preparing the training data again")
+		return None
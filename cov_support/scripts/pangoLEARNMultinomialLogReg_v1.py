@@ -1,4 +1,3 @@
-import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LogisticRegression
 from sklearn import metrics
@@ -8,6 +7,8 @@ from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_sc
 from datetime import datetime
 import joblib
 import sys
+import numpy as np
+from pangoLEARNEncoding import makeCodeLookup, oneHotEncode, oneHotHeaders, deduplicateRows, printDeduplicationReport, getCacheKey, saveTrainingData, loadTrainingData
 
 
 # file with lineage assignments
@@ -17,44 +18,10 @@ sequence_file = sys.argv[2]
 # how much of the data will be used for testing, instead of training
 testingPercentage = float(sys.argv[3])
 
-dataList = []
-
-snpDict = dict()
-keepDict = dict()
-# dict for lookup efficiency
-indiciesToKeep = dict()
-
-
-# small class for storing/comparing vector objects
-# useful for finding snps
-class VectorObject:
-	def __init__(self, vector):
-		self.vector = vector
-
-	def equals(self, vector):
-		for i in range(len(vector.vector)):
-			if vector.vector[i] != self.vector[i]:
-				return False
-
-		return True
-
-
-# geneate a one-hot encoded vector for a particular nucleotide
-def getOneHotEncoding(char):
-	# ATCGN-
-
-	if char == "A":
-		return VectorObject([1, 0, 0, 0, 0, 0])
-	elif char == "T":
-		return VectorObject([0, 1, 0, 0, 0, 0])
-	elif char == "C":
-		return VectorObject([0, 0, 1, 0, 0, 0])
-	elif char == "G":
-		return VectorObject([0, 0, 0, 1, 0, 0])
-	elif char == "-":
-		return VectorObject([0, 0, 0, 0, 0, 1])
-	else:
-		return VectorObject([0, 0, 0, 0, 1, 0])
+# nucleotide symbols in the order of the one-hot columns, anything else counts as N
+categories = "ATCGN-"
+categoryNames = ["A", "T", "C", "G", "N", "gap"]
+codeLookup = makeCodeLookup(categories, default=categories.index("N"))
 
 
 def readInAndFormatData():
@@ -103,121 +70,112 @@ def readInAndFormatData():
 	# close the file
 	f.close()
 
+	lineages = []
+	seqs = []
+
 	# for each sequence id
 	for key in idToSeq.keys():
 
-		# create a new dataLine
-		dataLine = []
-
 		# add the lineage
-		dataLine.append(idToLineage[key])
+		lineage = idToLineage[key]
 
 		if "lineage" in line:
 			# this is the header line. don't do anything.
 			print("skipping header")
 		else:
-			# for each character in the sequence
-			for char in idToSeq[key]:
-				# get the one hot encoding and append it to the line
-				dataLine.append(getOneHotEncoding(char))
-			# add the line ot the dataList
-			dataList.append(dataLine)
+			lineages.append(lineage)
+			seqs.append(idToSeq[key])
+
+	# the category code of every character of every sequence
+	codeMatrix = np.empty((len(seqs), len(seqs[0])), dtype=np.int8)
+
+	for i in range(len(seqs)):
+		if len(seqs[i]) != len(seqs[0]):
+			sys.stderr.write("Error: sequence length " + str(len(seqs[i])) + " does not match the length of the first sequence " + str(len(seqs[0])) + ", sequences must be aligned\n")
+			sys.exit(-1)
+
+		codeMatrix[i] = codeLookup[np.frombuffer(seqs[i].encode("latin-1", "replace"), dtype=np.uint8)]
 
+	return lineages, codeMatrix
 
-# find columns in the data list which always have the same value
-def findColumnsWithoutSNPs():
-	# for each index in the length of each sequence
-	for index in range(len(dataList[0])):
-		keep = False
 
-		# loop through all lines
-		for line in dataList:
-			# if there is a difference somewhere, then we want to keep it
-			if index == 0 or not dataList[0][index].equals(line[index]):
-				keep = True
+# find the columns of the matrix in which any sequence differs from the first one,
+# a block of rows at a time
+def findColumnsWithoutSNPs(codeMatrix, blockSize=1000):
+	keep = np.zeros(codeMatrix.shape[1], dtype=bool)
 
-		# otherwise, save it to remove this index from the data later
-		if keep:
-			indiciesToKeep[index] = True
+	for start in range(0, len(codeMatrix), blockSize):
+		keep |= (codeMatrix[start:start + blockSize] != codeMatrix[0]).any(axis=0)
 
+	return np.flatnonzero(keep)
 
-# remove columns from the data list which don't have any SNPs. We do this because
+
+# remove columns from the data which don't have any SNPs. We do this because
 # these columns won't be relevant for a logistic regression which is trying to use
 # differences between sequences to assign lineages
-def removeOtherIndices(indiciesToKeep):
-	# instantiate the final list
-	finalList = []
-
-	# initial headers, a list of all of the indicies in the sequences
-	headers = list(range(len(dataList[0])))
-
-	# will hold the final headers for the model
-	finalHeaders = []
-
-	# while the dataList isn't empty
-	while len(dataList) > 0:
-
-		# pop the first line
-		line = dataList.pop(0)
-
-		# initialize the finalLine
-		finalLine = []
-
-		for index in indiciesToKeep:
-			if index == 0:
-				# if its the first index, then that's the lineage assignment, so keep it
-				finalLine.append(line[0])
-			else:
-				# otherwise keep everything at the indices in indicesToKeep
-				finalLine.extend(line[index].vector)
-
-		# save the finalLine to the finalList
-		finalList.append(finalLine)
-
-	# getting the indices to remove as a list so we can sort it
-	indicies = list(indiciesToKeep.keys())
-	# sorting the list
-	indicies.sort()
-
-	# then, for each remaining header
-	for i in indicies:
-		# the first one is just "lineage" since we know its the lineage assignment
-		if i == 0:
-			finalHeaders.append("lineage")
-		# otherwise, we actually need several headers for each genomic location because of the one-hot encoding
-		else:
-			vector = [str(i) + "-A", str(i) + "-T", str(i) + "-C", str(i) + "-G", str(i) + "-N", str(i) + "-gap"]
-			finalHeaders.extend(vector)
+def removeOtherIndices(codeMatrix, indicies):
+
+	# one hot encoding of the remaining columns, six per genomic location
+	return oneHotEncode(codeMatrix[:, indicies], len(categories))
+
+
+# the headers for the model. The first header is just "lineage" since we know its the
+# lineage assignment, then there are several headers for each genomic location because
+# of the one-hot encoding. locations are counted from 1
+def getHeaders(indicies):
+	return ["lineage"] + oneHotHeaders(indicies + 1, categoryNames, "-")
+
+
+# read in and prepare the training data, returning the one-hot encoded features,
+# lineages, sample weights and the genome indices the features come from
+def prepareTrainingData():
+	print("reading in data " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"));
+
+	lineages, codeMatrix = readInAndFormatData()
+
+	# collapse identical sequences from the same lineage into one row, weighted by how many there were
+	uniqueRows, sampleWeights = deduplicateRows(codeMatrix, lineages)
+	codeMatrix = codeMatrix[uniqueRows]
+	lineages = np.asarray(lineages)[uniqueRows]
+
+	printDeduplicationReport(sampleWeights)
+
+	print("processing snps, formatting data " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"));
+
+	indiciesToKeep = findColumnsWithoutSNPs(codeMatrix)
 
-	# return
-	return finalList, finalHeaders
+	X = removeOtherIndices(codeMatrix, indiciesToKeep)
+	y = np.array(lineages)
 
+	return X, y, sampleWeights, indiciesToKeep
 
-print("reading in data " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"));
 
-readInAndFormatData()
+# the prepared training data is cached next to the sequence file, and used again 
+# as long as the lineage and sequence files haven't changed
+cacheFile = sequence_file + ".multinomialLogReg.npz"
+cacheKey = getCacheKey("multinomialLogReg", [lineage_file, sequence_file])
 
-print("processing snps, formatting data " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"));
+trainingData = loadTrainingData(cacheFile, cacheKey)
 
-findColumnsWithoutSNPs()
+if trainingData is None:
+	trainingData = prepareTrainingData()
+	saveTrainingData(cacheFile, cacheKey, *trainingData)
+else:
+	print("read training data from " + cacheFile)
 
-dataList, headers = removeOtherIndices(indiciesToKeep)
+X, y, sampleWeights, indiciesToKeep = trainingData
 
-pima = pd.DataFrame(dataList, columns=headers)
+headers = getHeaders(indiciesToKeep)
 
-# get the list of column names in list format
-# apparently there is a built in function in pandas letting you get the column header names this way
-feature_cols = list(pima)
+feature_cols = list(headers)
 
 print("setting up training " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"));
 
-# remove the last column from the data frame. This is because we are trying to predict these values.
+# remove the first column name, it is the lineage we are trying to predict
 h = feature_cols.pop(0)
-X = pima[feature_cols]
-y = pima[h]
 
 # separate the data frame into testing/training data sets. 25% of the data will be used for training, 75% for test.
-X_train,X_test,y_train,y_test=train_test_split(X,y,test_size=testingPercentage,random_state=0)
+X_train,X_test,y_train,y_test,weights_train,weights_test=train_test_split(X,y,sampleWeights,test_size=testingPercentage,random_state=0)
 
 print("training " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"));
 
@@ -225,7 +183,7 @@ print("training " + datetime.now().strftime("%m/%d/%Y, %H:%M:%S"));
 logreg = LogisticRegression(multi_class='multinomial',solver ='newton-cg')
 
 # fit the model
-logreg.fit(X_train,y_train)
+logreg.fit(X_train,y_train,sample_weight=weights_train)
 
 print("testing " + datetime.now().strftime("%H:%M:%S"));
 
@@ -239,20 +197,20 @@ print("generating statistics " + datetime.now().strftime("%H:%M:%S"));
 #print the confusion matrix
 print("--------------------------------------------")
 print("CONFUSION MATRIX")
-cnf_matrix = metrics.confusion_matrix(y_test, y_pred)
+cnf_matrix = metrics.confusion_matrix(y_test, y_pred, sample_weight=weights_test)
 print(cnf_matrix)
 
 print("--------------------------------------------")
 print("Classification report")
-print(metrics.classification_report(y_test, y_pred, digits=3))
+print(metrics.classification_report(y_test, y_pred, digits=3, sample_weight=weights_test))
 
 print("--------------------------------------------")
 print("Overall Stats")
 
-print("accuracy: " + str(accuracy_score(y_test, y_pred)))
-print("f1 score: " + str(f1_score(y_test, y_pred, average="macro")))
-print("precision: " + str(precision_score(y_test, y_pred, average="macro")))
-print("recall: " + str(recall_score(y_test, y_pred, average="macro")))
+print("accuracy: " + str(accuracy_score(y_test, y_pred, sample_weight=weights_test)))
+print("f1 score: " + str(f1_score(y_test, y_pred, average="macro", sample_weight=weights_test)))
+print("precision: " + str(precision_score(y_test, y_pred, average="macro", sample_weight=weights_test)))
+print("recall: " + str(recall_score(y_test, y_pred, average="macro", sample_weight=weights_test)))
 
 # save the model files to compressed joblib files
 # using joblib instead of pickle because these large files need to be compressed
@@ -17,45 +17,39 @@ rule seqs_with_lineage:
         aln = config["fasta"],
         lineages = config["lineages"]
     output:
-        fasta = os.path.join(config["outdir"], "sequences_with_lineage.fasta")
-    run:
-        to_write = []
-        with open(input.lineages,newline="") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                to_write.append(row["taxon"])
-        
-        with open(output.fasta, "w") as fw:
-            records = []
-            for record in SeqIO.parse(input.aln,"fasta"):
-                if "Wuhan/WH04/2020" == record.id:
-                    records.append(record)
-                elif record.id in to_write:
-                    records.append(record)
-            SeqIO.write(records, fw, "fasta")
+        packed = directory(os.path.join(config["outdir"], "sequences_with_lineage"))
+    shell:
+        """
+        pack_alignment.py -a {input.aln:q} -l {input.lineages:q} -o {output.packed:q}
+        """
 
 #input config all snp file
 
 rule find_all_snps:
     input:
-        aln = rules.seqs_with_lineage.output.fasta
+        aln = rules.seqs_with_lineage.output.packed
     output:
-        snps = os.path.join(config["outdir"] , "all_snps.csv")
+        snps = directory(os.path.join(config["outdir"] , "all_snps"))
+    params:
+        cache = f"--snp-cache '{config['snp_cache']}'" if config.get("snp_cache") else ""
+    threads: workflow.cores
     shell:
         """
-        find_all_snps.py -a {input.aln:q} -o {output.snps:q}
+        find_all_snps.py -a {input.aln:q} --snp-store {output.snps:q} --stream --threads {threads} {params.cache}
         """
 
 rule find_polytomies:
     input:
         tree = config["global_tree"]
     output:
-        outfile = os.path.join(config["outdir"] , "all_polytomies.csv")
+        outfile = os.path.join(config["outdir"] , "all_polytomies.csv"),
+        members = os.path.join(config["outdir"] , "all_polytomies.members.csv")
     shell:
         """
         get_polytomy.py \
             --global-tree {input.tree} \
-            --outfile {output.outfile}
+            --outfile {output.outfile} \
+            --members-out {output.members}
         """
 
 rule find_basal_polytomies:
@@ -71,15 +65,15 @@ rule find_basal_polytomies:
             --polytomies {input.polytomies} \
             --lineages {input.lineages} \
             --metadata {input.metadata} \
-            --outfile {output.outfile}
+            --outfile {output.outfile} \
+            --no-print-taxa
         """
 
 rule find_representatives:
     input:
-        aln = rules.seqs_with_lineage.output.fasta,
         lineages = config["lineages"],
         tree = config["global_tree"],
-        snps = os.path.join(config["outdir"] , "all_snps.csv"), #config["all_snps"],
+        snps = rules.find_all_snps.output.snps,
         include = config["to_include"],
         polytomies = rules.find_basal_polytomies.output.outfile
     params:
@@ -88,9 +82,9 @@ rule find_representatives:
         reps = os.path.join(config["outdir"] , "representative_seqs.csv"),
         defining = os.path.join(config["outdir"] , "defining_snps.csv"),
         mask = os.path.join(config["outdir"] , "singletons.csv"),
+    threads: workflow.cores
     shell:
         """categorise_snps.py \
-                -a {input.aln:q} \
                 -l {input.lineages:q} \
                 --snps {input.snps:q} \
                 --global-tree {input.tree} \
@@ -99,12 +93,13 @@ rule find_representatives:
                 --representative-seqs-out {output.reps:q} \
                 --defining-snps-out {output.defining:q} \
                 --mask-out {output.mask:q} \
-                --num-taxa {params.num_taxa}
+                --num-taxa {params.num_taxa} \
+                --threads {threads}
             """
 
 rule extract_representative_sequences:
     input:
-        aln = rules.seqs_with_lineage.output.fasta,
+        aln = rules.seqs_with_lineage.output.packed,
         lineages = config["lineages"],
         metadata = config["metadata"],
         mask = rules.find_representatives.output.mask,
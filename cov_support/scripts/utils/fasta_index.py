@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import os
+import collections
+
+"""
+Byte offset index of a fasta file, so that records can be fetched by id
+with a seek each instead of parsing the whole file.
+
+The index is saved next to the fasta as <fasta>.fxi and reused until the
+fasta changes. It is a tab separated file:
+
+#size   mtime_ns    of the fasta when it was indexed
+id      start   end     one line per record, start:end is the byte range
+                        of the record from its header line to the next header
+
+Unlike a samtools faidx index, the line lengths of the records don't have
+to be the same and duplicate ids are allowed.
+"""
+
+INDEX_SUFFIX = ".fxi"
+
+def get_file_signature(fasta):
+    """return the size and modification time of a file, which the index is checked against"""
+    stat = os.stat(fasta)
+    return f"#{stat.st_size}\t{stat.st_mtime_ns}"
+
+class FastaIndex():
+    """Random access to the records of a fasta file by id. The index is
+    read from the .fxi file if it is up to date, otherwise it is built
+    with one pass over the fasta and saved for next time"""
+    def __init__(self, fasta):
+        self.fasta = fasta
+        self.index_file = fasta + INDEX_SUFFIX
+        signature = get_file_signature(fasta)
+
+        self.entries = self.read_index(signature)
+        if self.entries is None:
+            self.entries = self.build_index()
+            self.write_index(signature)
+
+        self.offsets = collections.defaultdict(list)
+        for record_id, start, end in self.entries:
+            self.offsets[record_id].append((start, end))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, record_id):
+        return record_id in self.offsets
+
+    def read_index(self, signature):
+        """return the entries of the saved index, or None if there isn't
+        one or it was made from a different version of the fasta"""
+        if not os.path.exists(self.index_file):
+            return None
+        entries = []
+        with open(self.index_file) as f:
+            if f.readline().rstrip("\n") != signature:
+                return None
+            for l in f:
+                record_id, start, end = l.rstrip("\n").split("\t")
+                entries.append((record_id, int(start), int(end)))
+        return entries
+
+    def build_index(self):
+        """return (id, start, end) for every record in the fasta"""
+        entries = []
+        record_id = None
+        start = 0
+        offset = 0
+        with open(self.fasta, "rb") as f:
+            for line in f:
+                if line.startswith(b">"):
+                    if record_id is not None:
+                        entries.append((record_id, start, offset))
+                    record_id = line[1:].split(None, 1)[0].decode()
+                    start = offset
+                offset += len(line)
+        if record_id is not None:
+            entries.append((record_id, start, offset))
+        return entries
+
+    def write_index(self, signature):
+        """save the index next to the fasta. if that directory isn't writable
+        the index is just kept in memory"""
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                f.write(f"{signature}\n")
+                for record_id, start, end in self.entries:
+                    f.write(f"{record_id}\t{start}\t{end}\n")
+            os.replace(tmp_file, self.index_file)
+        except OSError:
+            print(f"Note: could not save the fasta index to {self.index_file}")
+
+    def fetch(self, ids):
+        """yield the id and sequence bytes of every record with an id in ids,
+        in the order of the fasta, seeking straight to each record"""
+        ranges = []
+        for record_id in set(ids):
+            for start, end in self.offsets.get(record_id, []):
+                ranges.append((start, end, record_id))
+        with open(self.fasta, "rb") as f:
+            for start, end, record_id in sorted(ranges):
+                f.seek(start)
+                lines = f.read(end - start).splitlines()
+                yield record_id, b"".join(line.rstrip() for line in lines[1:])
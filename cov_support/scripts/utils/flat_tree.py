@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import hashlib
+import itertools
+import zipfile
+import numpy as np
+
+"""
+Flat array representation of a tree, so that tree stages can work on
+numpy arrays instead of walking node objects recursively.
+
+Nodes are numbered in preorder: a node comes before its descendants and
+children are in the order they have in the tree file.
+
+parent[i]       index of the parent node, -1 for the root
+edge_length[i]  length of the edge to the parent, NaN if it has none
+is_leaf[i]      True for tips
+labels[i]       taxon label of a tip, "" for internal nodes
+
+Trees are read from newick or nexus files with a streaming tokenizer,
+labels are read the same way dendropy reads them (underscores in unquoted 
+labels are spaces, nexus translate tables are applied, internal node
+labels aren't taxa). The first tree in the file is read.
+
+read_tree caches the flat tree next to the tree file as <tree>.flat.npz, 
+with the hash of the tree file it was made from, and reuses it until
+the tree file changes:
+
+tree_hash       cache version and blake2b hash of the tree file
+parent, edge_length, is_leaf
+label_text      utf-8 bytes of all of the labels joined together
+label_lengths   length of each label in characters
+"""
+
+CACHE_SUFFIX = ".flat.npz"
+
+# change this whenever the flat tree format changes, so that caches
+# written by an older version are rebuilt
+CACHE_VERSION = 2
+
+TOKEN = re.compile(r"\s*('(?:[^']|'')*'|\[[^\]]*\]|[(),:;=]|[^\s(),:;=\[\]']+)")
+
+class FlatTree():
+    """A tree as parent, edge length and leaf flag arrays plus a label table"""
+    def __init__(self, parent, edge_length, is_leaf, labels):
+        self.parent = parent
+        self.edge_length = edge_length
+        self.is_leaf = is_leaf
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.parent)
+
+def tokenize_tree(handle, chunk_size=1 << 20):
+    """yield the tokens of a newick or nexus file a chunk at a time:
+    quoted labels, punctuation and unquoted words. comments are dropped"""
+    buffer = ""
+    pos = 0
+    eof = False
+    while True:
+        chunk = handle.read(chunk_size)
+        eof = chunk == ""
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            match = TOKEN.match(buffer, pos)
+            if match is None:
+                break
+            # a token that runs to the end of the chunk may carry on in the next one,
+            # and a quoted label followed by a ' is the start of a label with a '' in it
+            if not eof and (match.end() == len(buffer) or (match.group(1)[0] == "'" and buffer[match.end()] == "'")):
+                break
+            pos = match.end()
+            token = match.group(1)
+            if token[0] != "[":
+                yield token
+        if eof:
+            if buffer[pos:].strip():
+                raise ValueError(f"could not read the tree file at: {buffer[pos:pos + 50]}")
+            return
+
+def get_label(token):
+    """return the label of a quoted or unquoted label token"""
+    if token[0] == "'":
+        return token[1:-1].replace("''", "'")
+    return token.replace("_", " ")
+
+def parse_newick(tokens, translate=None):
+    """build a FlatTree from the tokens of a newick tree, up to the ; that ends it"""
+    parent = []
+    edge_length = []
+    is_leaf = []
+    labels = []
+    stack = []
+    last = -1
+    expect_child = True
+    for token in tokens:
+        if token == "(":
+            stack.append(len(parent))
+            parent.append(stack[-2] if len(stack) > 1 else -1)
+            edge_length.append(np.nan)
+            is_leaf.append(False)
+            labels.append("")
+            continue
+
+        if expect_child and token in ",):;":
+            # a tip without a label, e.g. (,A)
+            last = len(parent)
+            parent.append(stack[-1] if stack else -1)
+            edge_length.append(np.nan)
+            is_leaf.append(True)
+            labels.append("")
+            expect_child = False
+
+        if token == ",":
+            expect_child = True
+        elif token == ")":
+            last = stack.pop()
+        elif token == ":":
+            edge_length[last] = float(next(tokens))
+        elif token == ";":
+            break
+        elif expect_child:
+            label = get_label(token)
+            if translate:
+                label = translate.get(label, label)
+            last = len(parent)
+            parent.append(stack[-1] if stack else -1)
+            edge_length.append(np.nan)
+            is_leaf.append(True)
+            labels.append(label)
+            expect_child = False
+        # any other token is the label of an internal node, which isn't a taxon
+
+    return FlatTree(np.array(parent, dtype=np.int64), np.array(edge_length, dtype=np.float64), np.array(is_leaf, dtype=bool), labels)
+
+def parse_nexus(tokens):
+    """build a FlatTree from the first tree in the trees block of a nexus file"""
+    translate = {}
+    in_trees = False
+    for token in tokens:
+        word = token.lower()
+        if word == "begin":
+            in_trees = next(tokens).lower() == "trees"
+        elif word in ("end", "endblock"):
+            in_trees = False
+        elif in_trees and word == "translate":
+            key = next(tokens)
+            while key != ";":
+                translate[get_label(key)] = get_label(next(tokens))
+                key = next(tokens)
+                if key == ",":
+                    key = next(tokens)
+        elif in_trees and word in ("tree", "utree"):
+            while next(tokens) != "=":
+                pass
+            return parse_newick(tokens, translate)
+    raise ValueError("no tree found in the trees block of the nexus file")
+
+def parse_tree(handle):
+    """return the FlatTree of the first tree in a newick or nexus file"""
+    tokens = tokenize_tree(handle)
+    first = next(tokens, None)
+    if first is None:
+        raise ValueError("the tree file is empty")
+    if first.lower() == "#nexus":
+        return parse_nexus(tokens)
+    return parse_newick(itertools.chain([first], tokens))
+
+def hash_file(filename):
+    """return the blake2b hash of a file as hex"""
+    file_hash = hashlib.blake2b()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def save_flat_tree(flat_tree, cache_file, tree_hash):
+    """write a flat tree to an npz cache file"""
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_file, 
+        tree_hash=np.array(tree_hash),
+        parent=flat_tree.parent,
+        edge_length=flat_tree.edge_length,
+        is_leaf=flat_tree.is_leaf,
+        label_text=np.frombuffer("".join(flat_tree.labels).encode(), dtype=np.uint8),
+        label_lengths=np.array([len(label) for label in flat_tree.labels], dtype=np.int64))
+    os.replace(tmp_file, cache_file)
+
+def load_flat_tree(cache_file, tree_hash):
+    """return the flat tree in an npz cache file, or None if it
+    was made from a different tree file or can't be read"""
+    try:
+        with np.load(cache_file) as cache:
+            if str(cache["tree_hash"]) != tree_hash:
+                return None
+            text = cache["label_text"].tobytes().decode()
+            ends = np.cumsum(cache["label_lengths"]).tolist()
+            labels = [text[start:end] for start, end in zip([0] + ends[:-1], ends)]
+            return FlatTree(cache["parent"], cache["edge_length"], cache["is_leaf"], labels)
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+        print(f"Note: could not read the tree cache {cache_file}, rebuilding it")
+        return None
+
+def read_tree(tree_file):
+    """return the FlatTree of the first tree in a newick or nexus file, 
+    from the cache next to it if the tree file hasn't changed"""
+    tree_hash = f"{CACHE_VERSION}:{hash_file(tree_file)}"
+    cache_file = tree_file + CACHE_SUFFIX
+    if os.path.exists(cache_file):
+        flat_tree = load_flat_tree(cache_file, tree_hash)
+        if flat_tree is not None:
+            print(f"Read tree from cache {cache_file}")
+            return flat_tree
+
+    with open(tree_file) as f:
+        flat_tree = parse_tree(f)
+    try:
+        save_flat_tree(flat_tree, cache_file, tree_hash)
+    except OSError:
+        print(f"Note: could not save the tree cache to {cache_file}")
+    return flat_tree
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+from snp_functions import count_chars_in_rows, read_fasta
+from fasta_index import FastaIndex
+
+"""
+Packed alignment format: the alignment converted once from fasta into a
+fixed-width uint8 matrix, so scripts can memory-map it and slice rows
+without parsing the fasta or making SeqRecords. Readers in separate
+processes share the same pages of the OS page cache.
+
+A packed alignment is a directory containing:
+
+ids.txt     record ids, one per line, in alignment order
+seqs.bin    uint8 matrix of the aligned sequence characters, one row per record
+length.txt  alignment length, written last so that a pack that was only 
+            partly written can be told apart
+"""
+
+LENGTH_FILE = "length.txt"
+
+def is_packed_alignment(path):
+    """packed alignments are directories, fasta files are files"""
+    return os.path.isdir(path)
+
+def pack_alignment(fasta, path, keep=None):
+    """convert a fasta alignment into a packed alignment at path in one pass.
+    if keep is given, only the records with ids in keep are packed, 
+    fetched from the fasta through its index.
+    returns the number of records packed"""
+    if not os.path.exists(path):
+        os.mkdir(path)
+    length_file = os.path.join(path, LENGTH_FILE)
+    if os.path.exists(length_file):
+        os.remove(length_file)
+    width = None
+    c = 0
+    with open(fasta, "rb") as f, open(os.path.join(path, "ids.txt"), "w") as fi, open(os.path.join(path, "seqs.bin"), "wb") as fs:
+        records = read_fasta(f) if keep is None else FastaIndex(fasta).fetch(keep)
+        for record_id, seq in records:
+            if width is None:
+                width = len(seq)
+            elif len(seq) != width:
+                raise ValueError(f"{record_id} has length {len(seq)} but the alignment has length {width}, sequences must be aligned")
+            fi.write(f"{record_id}\n")
+            fs.write(seq)
+            c += 1
+    with open(length_file, "w") as f:
+        f.write(f"{width or 0}\n")
+    return c
+
+class PackedAlignment():
+    """Read access to a packed alignment. matrix is memory-mapped,
+    so rows are only read from disk when they are used"""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "ids.txt")) as f:
+            self.ids = f.read().splitlines()
+        self.index = {record_id: i for i, record_id in enumerate(self.ids)}
+
+        seqs_file = os.path.join(path, "seqs.bin")
+        size = os.path.getsize(seqs_file)
+        length_file = os.path.join(path, LENGTH_FILE)
+        if not os.path.exists(length_file):
+            raise ValueError(f"{length_file} is missing, the packed alignment was only partly written, please pack the alignment again")
+        with open(length_file) as f:
+            length = int(f.read())
+        if size != len(self.ids) * length:
+            raise ValueError(f"{seqs_file} is {size} bytes but should be {len(self.ids) * length} for {len(self.ids)} sequences of length {length}, the packed alignment is out of date or was only partly written, please pack the alignment again")
+
+        if size == 0:
+            self.matrix = np.zeros((len(self.ids), 0), dtype=np.uint8)
+        else:
+            self.matrix = np.memmap(seqs_file, dtype=np.uint8, mode="r", shape=(len(self.ids), length))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, record_id):
+        return record_id in self.index
+
+    def get_alignment_length(self):
+        return self.matrix.shape[1]
+
+    def get_row(self, record_id):
+        """return the uint8 row of a record, or None if it is not in the alignment"""
+        if record_id not in self.index:
+            return None
+        return self.matrix[self.index[record_id]]
+
+    def fetch(self, ids):
+        """yield the id and sequence bytes of every record with an id in ids,
+        in alignment order, the same as FastaIndex.fetch"""
+        rows = sorted(self.index[record_id] for record_id in set(ids) if record_id in self.index)
+        for i in rows:
+            yield self.ids[i], self.matrix[i].tobytes()
+
+    def get_shards(self, num_shards):
+        """split the rows into at most num_shards (start, end) ranges"""
+        bounds = sorted(set(len(self.ids) * i // num_shards for i in range(num_shards + 1)))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def count_chars(self, chars, block_size=1000):
+        """return the number of occurrences of any of chars (bytes) in each row"""
+        counts = np.zeros(len(self.ids), dtype=np.int64)
+        for start in range(0, len(self.ids), block_size):
+            counts[start:start + block_size] = count_chars_in_rows(self.matrix[start:start + block_size], chars)
+        return counts
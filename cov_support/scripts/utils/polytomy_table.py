@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import csv
+
+"""
+Polytomy tables written by get_polytomy.py. Each taxon gets the id of its 
+polytomy and the members of each polytomy are written once, so the tables 
+grow linearly with the number of taxa in polytomies:
+
+--outfile
+name,polytomy_id
+taxon1,0
+
+--members-out
+polytomy_id,members
+0,taxon1;taxon2;taxon3
+
+read_polytomies also reads the older single table, which had the members 
+of the whole polytomy on every member's row:
+
+name,polytomy
+taxon1,taxon1;taxon2;taxon3
+"""
+
+def write_polytomies(polytomy_ids, polytomies, outfile, members_outfile):
+    """write a dict of taxon to polytomy id and the list of polytomies
+    (lists of taxa, indexed by polytomy id) as the two tables"""
+    outfile.write("name,polytomy_id\n")
+    for taxon in polytomy_ids:
+        outfile.write(f"{taxon},{polytomy_ids[taxon]}\n")
+
+    members_outfile.write("polytomy_id,members\n")
+    for polytomy_id, members in enumerate(polytomies):
+        members_str = ";".join(members)
+        members_outfile.write(f"{polytomy_id},{members_str}\n")
+
+def read_polytomies(polytomy_file, members_file=None):
+    """return a dict of taxon to polytomy id and a dict of polytomy id 
+    to its list of members. the members are only read if the members
+    table is given, or if the polytomy table is in the old format"""
+    polytomy_ids = {}
+    members = {}
+    with open(polytomy_file, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        if header[1] == "polytomy":
+            ids_by_members = {}
+            for name, polytomy in reader:
+                if polytomy not in ids_by_members:
+                    ids_by_members[polytomy] = len(ids_by_members)
+                    members[ids_by_members[polytomy]] = polytomy.split(";")
+                polytomy_ids[name] = ids_by_members[polytomy]
+            return polytomy_ids, members
+
+        for name, polytomy_id in reader:
+            polytomy_ids[name] = int(polytomy_id)
+
+    if members_file:
+        with open(members_file, newline="") as f:
+            reader = csv.reader(f)
+            next(reader)
+            for polytomy_id, polytomy in reader:
+                members[int(polytomy_id)] = polytomy.split(";")
+    return polytomy_ids, members
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import sqlite3
+import numpy as np
+from snp_functions import call_snps_in_matrix, hash_sequence
+
+"""
+On-disk cache of the snps found for each taxon, so that a rerun of
+find_all_snps.py only has to call snps for new or changed sequences.
+
+The cache is an sqlite database with one row per taxon:
+taxon, hash of the aligned sequence, snps as packed (position, ref, alt) records
+
+Cached snps are only used if the hash of the sequence is unchanged,
+and the whole cache is emptied if the reference sequence changes.
+"""
+
+SNP_DTYPE = np.dtype([("position", "<i4"), ("ref", "u1"), ("alt", "u1")])
+
+class SnpCache():
+    """Snp cache backed by an sqlite file.
+
+    Lookups and newly called snps go through call_snps. In the main process
+    (readonly=False) new snps are written straight to the database. Worker
+    processes open the cache readonly and hand their new entries back to the
+    main process with take_pending, which writes them with add_pending."""
+    def __init__(self, path, ref_map, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.hits = 0
+        self.misses = 0
+        self.new_entries = []
+        self.seen = []
+
+        self.db = sqlite3.connect(path, timeout=60)
+        if not readonly:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS snps (taxon TEXT PRIMARY KEY, seq_hash BLOB, snps BLOB)")
+            self.db.execute("CREATE TEMP TABLE seen (taxon TEXT PRIMARY KEY)")
+
+            ref_hash = hash_sequence(ref_map.ref_row).hex()
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'reference'").fetchone()
+            if row is None or row[0] != ref_hash:
+                if row is not None:
+                    print("Reference has changed, emptying the snp cache")
+                self.db.execute("DELETE FROM snps")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('reference', ?)", (ref_hash,))
+            self.db.commit()
+
+    def lookup(self, ids, hashes):
+        """return a dict of row index to cached snp records for
+        the taxa whose sequence hash matches the cache"""
+        cached = {}
+        for i, (record_id, seq_hash) in enumerate(zip(ids, hashes)):
+            row = self.db.execute("SELECT seq_hash, snps FROM snps WHERE taxon = ?", (record_id,)).fetchone()
+            if row is not None and row[0] == seq_hash:
+                cached[i] = np.frombuffer(row[1], dtype=SNP_DTYPE)
+        return cached
+
+    def call_snps(self, ids, matrix, ref_map, hashes=None):
+        """same as call_snps_in_matrix, but only calls snps for the rows
+        of the block that are not already in the cache. 
+        hashes of the rows are made here unless they are given"""
+        if hashes is None:
+            hashes = [hash_sequence(row) for row in matrix]
+        row_snps = self.lookup(ids, hashes)
+        miss_rows = [i for i in range(len(ids)) if i not in row_snps]
+
+        rows, positions, refs, alts = call_snps_in_matrix(ref_map, matrix[miss_rows])
+        new_snps = np.empty(len(rows), dtype=SNP_DTYPE)
+        new_snps["position"] = positions
+        new_snps["ref"] = refs
+        new_snps["alt"] = alts
+        ends = np.cumsum(np.bincount(rows, minlength=len(miss_rows)))
+        for i, start, end in zip(miss_rows, np.concatenate(([0], ends[:-1])).tolist(), ends.tolist()):
+            row_snps[i] = new_snps[start:end]
+            self.new_entries.append((ids[i], hashes[i], new_snps[start:end].tobytes()))
+
+        self.hits += len(ids) - len(miss_rows)
+        self.misses += len(miss_rows)
+        self.seen.extend(ids)
+        if not self.readonly:
+            self.add_pending(*self.take_pending())
+
+        block_snps = [row_snps[i] for i in range(len(ids))]
+        all_snps = np.concatenate(block_snps) if block_snps else np.empty(0, dtype=SNP_DTYPE)
+        rows = np.repeat(np.arange(len(ids)), [len(snps) for snps in block_snps])
+        return rows, all_snps["position"], all_snps["ref"], all_snps["alt"]
+
+    def take_pending(self):
+        """return and clear the new entries and seen taxa not yet written"""
+        pending = (self.new_entries, self.seen)
+        self.new_entries = []
+        self.seen = []
+        return pending
+
+    def add_pending(self, new_entries, seen):
+        """write new (taxon, seq_hash, snps) entries and note the taxa seen in this run"""
+        self.db.executemany("INSERT OR REPLACE INTO snps VALUES (?, ?, ?)", new_entries)
+        self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((taxon,) for taxon in seen))
+        self.db.commit()
+
+    def evict(self):
+        """drop the entries of taxa that were not in this run's alignment,
+        returns the number of entries dropped"""
+        evicted = self.db.execute("DELETE FROM snps WHERE taxon NOT IN (SELECT taxon FROM seen)").rowcount
+        self.db.commit()
+        return evicted
+
+    def close(self):
+        self.db.close()
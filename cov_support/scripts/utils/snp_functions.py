@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+import numpy as np
+
+"""
+Array based snp calling shared by the pangolin prep scripts.
+
+Sequences are handled as uint8 arrays of their characters so a whole
+block of an alignment can be compared to the reference row in one go.
+"""
+
+GAP = ord("-")
+
+# characters that count as an unambiguous call in the member sequence
+VALID_BASES = np.zeros(256, dtype=bool)
+VALID_BASES[np.frombuffer(b"ACGTacgt-", dtype=np.uint8)] = True
+
+UPPER = np.arange(256, dtype=np.uint8)
+UPPER[ord("a"):ord("z") + 1] -= 32
+
+CHARS = [chr(i) for i in range(256)]
+
+AMBIGUITY_CODES = b"RYKMSWBDHVrykmswbdhv"
+
+def seq_to_array(seq):
+    """return a sequence as a uint8 array of its characters"""
+    return np.frombuffer(str(seq).encode(), dtype=np.uint8)
+
+def alignment_to_matrix(alignment):
+    """return the record ids and a uint8 matrix with one row per record"""
+    ids = []
+    matrix = np.empty((len(alignment), alignment.get_alignment_length()), dtype=np.uint8)
+    for i, record in enumerate(alignment):
+        ids.append(record.id)
+        matrix[i] = seq_to_array(record.seq)
+    return ids, matrix
+
+def count_chars_in_rows(matrix, chars):
+    """return the number of occurrences of any of chars (bytes) in each row of a uint8 matrix"""
+    lookup = np.zeros(256, dtype=bool)
+    lookup[np.frombuffer(chars, dtype=np.uint8)] = True
+    return lookup[matrix].sum(axis=1)
+
+def hash_sequence(seq):
+    """return a 16 byte hash of a sequence (bytes or uint8 array)"""
+    return hashlib.blake2b(seq, digest_size=16).digest()
+
+def get_seq_stats(matrix):
+    """return a dict of qc stats for each row of a uint8 alignment matrix:
+        num_N: N (or n) characters
+        num_gap: gap characters
+        num_ambiguous: iupac ambiguity codes other than N
+        effective_length: unambiguous A, C, G or T calls
+        length: aligned length
+        seq_hash: hash_sequence of the row"""
+    return {
+        "num_N": count_chars_in_rows(matrix, b"Nn"),
+        "num_gap": count_chars_in_rows(matrix, b"-"),
+        "num_ambiguous": count_chars_in_rows(matrix, AMBIGUITY_CODES),
+        "effective_length": count_chars_in_rows(matrix, b"ACGTacgt"),
+        "length": np.full(len(matrix), matrix.shape[1]),
+        "seq_hash": np.array([hash_sequence(row) for row in matrix], dtype="V16")
+    }
+
+def read_fasta(handle):
+    """yield the id and sequence bytes of each record in a fasta file opened
+    in binary mode, one record at a time and without making SeqRecords"""
+    record_id = None
+    lines = []
+    for line in handle:
+        if line.startswith(b">"):
+            if record_id is not None:
+                yield record_id, b"".join(lines)
+            record_id = line[1:].split(None, 1)[0].decode()
+            lines = []
+        else:
+            lines.append(line.rstrip())
+    if record_id is not None:
+        yield record_id, b"".join(lines)
+
+def read_lines_in_range(handle, start, end):
+    """yield the lines of a file opened in binary mode that start 
+    at or after byte offset start and before byte offset end"""
+    handle.seek(start)
+    offset = start
+    for line in handle:
+        if offset >= end:
+            break
+        yield line
+        offset += len(line)
+
+def get_fasta_shards(fasta, num_shards):
+    """split a fasta file into at most num_shards (start, end) byte ranges,
+    each of which starts at the beginning of a record"""
+    size = os.path.getsize(fasta)
+    starts = [0]
+    with open(fasta, "rb") as f:
+        for i in range(1, num_shards):
+            f.seek(max(size * i // num_shards, starts[-1]))
+            if f.tell() > 0:
+                f.readline()
+            offset = f.tell()
+            line = f.readline()
+            while line and not line.startswith(b">"):
+                offset += len(line)
+                line = f.readline()
+            if line and offset > starts[-1]:
+                starts.append(offset)
+    ends = starts[1:] + [size]
+    return list(zip(starts, ends))
+
+def get_reference_row(fasta, reference_id=None):
+    """return the row of the record called reference_id (or of the first record
+    if no id is given) in a fasta file, reading only as far as that record"""
+    with open(fasta, "rb") as f:
+        for record_id, seq in read_fasta(f):
+            if reference_id is None or record_id == reference_id:
+                return np.frombuffer(seq, dtype=np.uint8)
+    return None
+
+class ReferenceMap():
+    """Coordinate lookups between alignment columns and positions in the 
+    ref seq (i.e. no gaps in ref), built once from the reference row.
+
+    column_to_position[col]: position of every column, columns in a gap in the 
+        reference share the position of the reference base before them
+    position_to_column[pos]: column of the reference base at each 1-based position, 
+        with 0 at index 0 and the alignment length as the last entry, so the 
+        columns at a position are position_to_column[pos]:position_to_column[pos + 1]
+    """
+    def __init__(self, ref_row):
+        self.ref_row = ref_row
+        is_base = ref_row != GAP
+
+        self.column_to_position = np.cumsum(is_base)
+        self.position_to_column = np.concatenate(([0], np.flatnonzero(is_base), [len(ref_row)]))
+
+    def __len__(self):
+        return len(self.ref_row)
+
+    def get_columns(self, positions):
+        """return the alignment columns at each of an array of positions in the ref seq,
+        as the index into positions and the column of every (position, column) pair.
+        positions past the end of the ref seq have no columns"""
+        in_range = positions < len(self.position_to_column) - 1
+        positions = np.where(in_range, positions, 0)
+        starts = self.position_to_column[positions]
+        lengths = np.where(in_range, self.position_to_column[positions + 1] - starts, 0)
+        position_ids = np.repeat(np.arange(len(positions)), lengths)
+        return position_ids, np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+
+def format_snps(positions, refs, alts):
+    """return a list of snp strings (e.g. 2897GT) for position, ref and alt arrays"""
+    return [f"{pos}{CHARS[ref]}{CHARS[alt]}" for pos, ref, alt in zip(positions.tolist(), refs.tolist(), alts.tolist())]
+
+def call_snps_in_matrix(ref_map, matrix):
+    """Identifies unambiguous snps between the reference row and every row
+    of a uint8 alignment matrix. Returns the row, position in the ref seq 
+    and upper case ref and alt characters of every snp as arrays, sorted by 
+    row and then by alignment column, which is also sorted by position in the genome"""
+    ref_row = ref_map.ref_row
+    is_snp = (matrix != ref_row) & VALID_BASES[matrix]
+    rows, cols = np.nonzero(is_snp)
+    return rows, ref_map.column_to_position[cols], UPPER[ref_row[cols]], UPPER[matrix[rows, cols]]
+
+def parse_snps(snps):
+    """return position, ref and alt arrays for snp strings (e.g. 2897GT), 
+    skipping anything that isn't a snp, such as the empty snp"""
+    snps = [snp for snp in snps if len(snp) > 2 and snp[:-2].isdigit()]
+    positions = np.array([int(snp[:-2]) for snp in snps], dtype=np.int64)
+    refs = np.array([ord(snp[-2]) for snp in snps], dtype=np.uint8)
+    alts = np.array([ord(snp[-1]) for snp in snps], dtype=np.uint8)
+    return positions, refs, alts
+
+def mask_snps(ref_map,member_row,to_mask):
+    """Masks a member uint8 row in one go: the snps in to_mask (position, 
+    ref and alt arrays from parse_snps) are mapped to their alignment columns, 
+    and every one of those columns at which the member has that unambiguous snp
+    is set to `?` in a copy of the row. Returns the masked row, the number of 
+    snps before masking and the number of snps masked"""
+    ref_row = ref_map.ref_row
+    is_snp = (member_row != ref_row) & VALID_BASES[member_row]
+
+    positions, refs, alts = to_mask
+    snp_ids, columns = ref_map.get_columns(positions)
+    matches = is_snp[columns] & (UPPER[ref_row[columns]] == refs[snp_ids]) & (UPPER[member_row[columns]] == alts[snp_ids])
+    masked_columns = np.unique(columns[matches])
+
+    masked_row = np.array(member_row)
+    masked_row[masked_columns] = ord("?")
+    return masked_row, int(is_snp.sum()), len(masked_columns)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+from snp_functions import format_snps
+
+"""
+Binary columnar snp table written by find_all_snps.py.
+
+A snp store is a directory of flat little-endian arrays, one value per snp
+unless noted, that can be memory-mapped with numpy:
+
+taxa.txt        taxon names, one per line, in alignment order
+offsets.bin     int64, one per taxon plus one. snps of taxon i are offsets[i]:offsets[i+1]
+taxon.bin       int32 index of the taxon in taxa.txt
+position.bin    int32 position in the ref seq
+ref.bin         uint8 reference base character
+alt.bin         uint8 alternate base character
+
+and per taxon qc stats of the aligned sequence, from the same pass that
+called the snps (see get_seq_stats), so the alignment needn't be read again:
+
+num_N.bin               int32 N characters
+num_gap.bin             int32 gap characters
+num_ambiguous.bin       int32 ambiguity codes other than N
+effective_length.bin    int32 unambiguous A, C, G or T calls
+length.bin              int32 aligned length
+seq_hash.bin            16 byte hash of the aligned sequence
+
+snps of each taxon are stored in the same order as the `;`-joined string
+in the taxon,snps csv (2897GT;30000TA).
+"""
+
+COLUMNS = [("taxon", "<i4"), ("position", "<i4"), ("ref", "u1"), ("alt", "u1")]
+STATS_COLUMNS = [("num_N", "<i4"), ("num_gap", "<i4"), ("num_ambiguous", "<i4"), ("effective_length", "<i4"), ("length", "<i4"), ("seq_hash", "V16")]
+
+class SnpStoreWriter():
+    """Writes a snp store a block of taxa at a time, so it never
+    needs to hold more than one block in memory"""
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.mkdir(path)
+        self.num_taxa = 0
+        self.num_snps = 0
+        self.taxa_file = open(os.path.join(path, "taxa.txt"), "w")
+        self.offsets_file = open(os.path.join(path, "offsets.bin"), "wb")
+        self.column_files = {}
+        for column, dtype in COLUMNS + STATS_COLUMNS:
+            self.column_files[column] = open(os.path.join(path, f"{column}.bin"), "wb")
+        self.offsets_file.write(np.zeros(1, dtype="<i8").tobytes())
+
+    def write_block(self, ids, rows, positions, refs, alts, stats):
+        """add the snps for a block of taxa, with the row of each snp within
+        the block in rows. snps must be sorted by row. 
+        stats is a dict of each stats column for the taxa in the block"""
+        counts = np.bincount(rows, minlength=len(ids))
+        offsets = self.num_snps + np.cumsum(counts)
+
+        for record_id in ids:
+            self.taxa_file.write(f"{record_id}\n")
+        self.offsets_file.write(offsets.astype("<i8").tobytes())
+        self.column_files["taxon"].write((np.asarray(rows) + self.num_taxa).astype("<i4").tobytes())
+        self.column_files["position"].write(np.asarray(positions).astype("<i4").tobytes())
+        self.column_files["ref"].write(np.asarray(refs).astype("u1").tobytes())
+        self.column_files["alt"].write(np.asarray(alts).astype("u1").tobytes())
+        for column, dtype in STATS_COLUMNS:
+            self.column_files[column].write(np.asarray(stats[column]).astype(dtype).tobytes())
+
+        self.num_taxa += len(ids)
+        self.num_snps += len(rows)
+
+    def append_store(self, store):
+        """add all of the taxa and snps in another store, e.g. a shard of the alignment"""
+        rows = np.asarray(store.taxon)
+        self.write_block(store.taxa, rows, store.position, store.ref, store.alt, store.get_stats())
+
+    def close(self):
+        self.taxa_file.close()
+        self.offsets_file.close()
+        for column in self.column_files:
+            self.column_files[column].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_column(filename, dtype, mmap=True):
+    """return the array in a store file, memory-mapped unless mmap is False"""
+    if os.path.getsize(filename) == 0:
+        return np.zeros(0, dtype=dtype)
+    if mmap:
+        return np.memmap(filename, dtype=dtype, mode="r")
+    return np.fromfile(filename, dtype=dtype)
+
+class SnpStore():
+    """Read access to a snp store written by SnpStoreWriter"""
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(os.path.join(path, "taxa.txt")) as f:
+            self.taxa = f.read().splitlines()
+        self.offsets = read_column(os.path.join(path, "offsets.bin"), "<i8", mmap)
+        for column, dtype in COLUMNS:
+            setattr(self, column, read_column(os.path.join(path, f"{column}.bin"), dtype, mmap))
+        self.has_stats = all(os.path.exists(os.path.join(path, f"{column}.bin")) for column, dtype in STATS_COLUMNS)
+        if self.has_stats:
+            for column, dtype in STATS_COLUMNS:
+                setattr(self, column, read_column(os.path.join(path, f"{column}.bin"), dtype, mmap))
+        self._index = None
+
+    def __len__(self):
+        return len(self.taxa)
+
+    @property
+    def index(self):
+        """dict of taxon name to its index in the store"""
+        if self._index is None:
+            self._index = {taxon: i for i, taxon in enumerate(self.taxa)}
+        return self._index
+
+    def get_stats(self):
+        """return a dict of each stats column, None for a store written
+        before stats were added"""
+        if not self.has_stats:
+            return None
+        return {column: getattr(self, column) for column, dtype in STATS_COLUMNS}
+
+    def get_snps(self, taxon):
+        """return the list of snps of a taxon"""
+        i = self.index[taxon]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return format_snps(self.position[start:end], self.ref[start:end], self.alt[start:end])
+
+    def snp_strings(self, block_size=10000):
+        """yield (taxon, snp string) for every taxon in the store, in order"""
+        for block_start in range(0, len(self.taxa), block_size):
+            block_end = min(block_start + block_size, len(self.taxa))
+            offsets = self.offsets[block_start:block_end + 1].tolist()
+            start, end = offsets[0], offsets[-1]
+            snps = format_snps(self.position[start:end], self.ref[start:end], self.alt[start:end])
+            for i, taxon in enumerate(self.taxa[block_start:block_end]):
+                yield taxon, ";".join(snps[offsets[i] - start:offsets[i + 1] - start])
+
+    def write_csv(self, outfile):
+        """export the store as the taxon,snps csv"""
+        outfile.write("taxon,snps\n")
+        for taxon, snp_string in self.snp_strings():
+            outfile.write(f"{taxon},{snp_string}\n")
@@ -22,11 +22,19 @@ setup(name='cov-support',
       "cov_support/scripts/get_masked_representatives.py",
       "cov_support/scripts/categorise_snps.py",
       "cov_support/scripts/find_all_snps.py",
+      "cov_support/scripts/pack_alignment.py",
       "cov_support/scripts/make_summary_table.py",
       "cov_support/scripts/lineage_distributions.R",
       "cov_support/scripts/utils/parse_data.py",
       "cov_support/scripts/utils/class_defs.py",
       "cov_support/scripts/utils/time_functions.py",
+      "cov_support/scripts/utils/snp_functions.py",
+      "cov_support/scripts/utils/snp_store.py",
+      "cov_support/scripts/utils/snp_cache.py",
+      "cov_support/scripts/utils/packed_alignment.py",
+      "cov_support/scripts/utils/fasta_index.py",
+      "cov_support/scripts/utils/flat_tree.py",
+      "cov_support/scripts/utils/polytomy_table.py",
       "cov_support/scripts/update_web_pages.py"],
       install_requires=[
             "biopython>=1.70",